@@ -0,0 +1,209 @@
+"""
+Adaptive batch sizes for inference steps.
+
+An inference step whose `generation_settings.batch_size` is `auto` (or every
+inference step, if AUTOTUNE_BATCH_SIZE is enabled) runs with the largest
+batch size that fits in the memory currently available on the model's
+device. The per-image memory cost is estimated from the size of the crops
+that are about to be processed, and on CUDA it is refined with the peak
+memory measured on earlier batches. A batch that runs out of memory is
+retried with half the batch size instead of failing the job.
+
+`run_step` is also where the resolution cap of app.preprocessing is applied.
+"""
+
+import gc
+import logging
+import os
+import threading
+
+import torch
+from htrflow.pipeline.steps import Inference
+from htrflow.volume.volume import Collection
+
+from app.preprocessing import pop_max_side, predict_capped, scale_factor
+
+logger = logging.getLogger(__name__)
+
+AUTO = "auto"
+
+# Set AUTOTUNE_BATCH_SIZE=true to autotune all inference steps, including
+# those with a fixed batch size in their config
+AUTOTUNE_ALL = os.environ.get("AUTOTUNE_BATCH_SIZE", "false") == "true"
+
+# Upper bound of autotuned batch sizes
+AUTOTUNE_MAX_BATCH = int(os.environ.get("AUTOTUNE_MAX_BATCH", 64))
+
+# Share of the available memory that a batch may use
+AUTOTUNE_MEMORY_FRACTION = float(os.environ.get("AUTOTUNE_MEMORY_FRACTION", 0.7))
+
+# Initial estimate (in MB) of the memory a model needs per image, on top of
+# the image itself. Replaced by measurements on CUDA devices.
+AUTOTUNE_ITEM_MB = int(os.environ.get("AUTOTUNE_ITEM_MB", 64))
+
+# Copies of a crop made during preprocessing (resizing, float conversion)
+_CROP_COPIES = 4
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Check if an exception was caused by the model running out of memory."""
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def available_memory(device: torch.device) -> int:
+    """Free memory on device, in bytes."""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class BatchSizeTuner:
+    """
+    Batch size state of one inference step.
+
+    Keeps the estimated memory cost per image and the largest batch size
+    known to fit, which is lowered after an out-of-memory error.
+    """
+
+    def __init__(self):
+        self.item_bytes = AUTOTUNE_ITEM_MB * 1024**2
+        self.ceiling = AUTOTUNE_MAX_BATCH
+        self._lock = threading.Lock()
+
+    def batch_size(self, device: torch.device, crop_sizes: list[int]) -> int:
+        """
+        Pick the batch size for the next batch.
+
+        Args:
+            device: Device of the model
+            crop_sizes: Size (in bytes) of the images that remain to be
+                processed, in order
+
+        Returns:
+            The largest batch size whose estimated memory use fits the
+            available memory, at least 1
+        """
+        budget = available_memory(device) * AUTOTUNE_MEMORY_FRACTION
+        with self._lock:
+            item_bytes, ceiling = self.item_bytes, self.ceiling
+
+        used = 0
+        size = 0
+        for crop_size in crop_sizes[: min(ceiling, AUTOTUNE_MAX_BATCH)]:
+            used += item_bytes + _CROP_COPIES * crop_size
+            if used > budget and size > 0:
+                break
+            size += 1
+        return max(size, 1)
+
+    def record(self, batch_size: int, crop_bytes: int, peak_bytes: int):
+        """Update the per-image estimate from the measured peak memory of a batch."""
+        measured = max(peak_bytes - _CROP_COPIES * crop_bytes, 0) / batch_size
+        with self._lock:
+            self.item_bytes = int((self.item_bytes + measured) / 2)
+
+    def backoff(self, batch_size: int) -> int:
+        """Lower the ceiling after batch_size ran out of memory."""
+        with self._lock:
+            self.ceiling = min(self.ceiling, max(batch_size // 2, 1))
+            return self.ceiling
+
+
+# Tuners by step cache key, so that all copies of a cached step (see
+# app.step_cache) share the batch size state of their model
+_tuners: dict[str, BatchSizeTuner] = {}
+_tuners_lock = threading.Lock()
+
+
+def _tuner(step: Inference) -> BatchSizeTuner:
+    key = getattr(step, "cache_key", None)
+    if key is None:
+        # Steps built outside the step cache keep their state for one run
+        return BatchSizeTuner()
+    with _tuners_lock:
+        return _tuners.setdefault(key, BatchSizeTuner())
+
+
+def run_step(step, collection: Collection) -> Collection:
+    """
+    Run a pipeline step with an autotuned batch size and resolution cap.
+
+    Inference steps without an autotuned batch size or a resolution cap
+    (see app.preprocessing), and all other steps, are run with `step.run`.
+    """
+    if not isinstance(step, Inference):
+        return step.run(collection)
+
+    generation_kwargs = dict(step.generation_kwargs)
+    batch_size = generation_kwargs.pop("batch_size", 1)
+    nodes = list(collection.active_leaves())
+    max_side = pop_max_side(step, generation_kwargs, nodes)
+    autotuned = AUTOTUNE_ALL or batch_size == AUTO
+    if not autotuned and not max_side and "max_side" not in step.generation_kwargs:
+        return step.run(collection)
+
+    if step.model is None:
+        step._init_model()
+
+    device = step.model.device
+    tuner = _tuner(step) if autotuned else None
+    crop_sizes = []
+    for node in nodes:
+        factor = scale_factor(node.width, node.height, max_side)
+        crop_sizes.append(int(node.width * node.height * 3 * factor**2))
+
+    results = []
+    start = 0
+    while start < len(nodes):
+        if tuner is not None:
+            batch_size = tuner.batch_size(device, crop_sizes[start:])
+        batch = nodes[start : start + batch_size]
+        crop_bytes = sum(crop_sizes[start : start + batch_size])
+        try:
+            if tuner is not None and device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+                baseline = torch.cuda.memory_allocated(device)
+            batch_results = predict_capped(
+                step.model, batch, max_side, batch_size=batch_size, **generation_kwargs
+            )
+        except Exception as e:
+            if tuner is None or not is_out_of_memory(e) or batch_size == 1:
+                raise
+            ceiling = tuner.backoff(batch_size)
+            logger.warning(
+                "%s ran out of memory with batch size %d, retrying with %d",
+                step,
+                batch_size,
+                ceiling,
+            )
+            gc.collect()
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            continue
+
+        if tuner is not None and device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated(device) - baseline
+            tuner.record(batch_size, crop_bytes, peak)
+        results.extend(batch_results)
+        start += len(batch)
+
+    if tuner is not None:
+        logger.info(
+            "%s: processed %d image(s) with autotuned batch sizes (ceiling %d)",
+            step,
+            len(nodes),
+            tuner.ceiling,
+        )
+    collection.update(results)
+    return collection
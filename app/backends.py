@@ -0,0 +1,220 @@
+"""
+Optimized CPU inference backends for TrOCR and YOLO steps.
+
+A step selects its backend with a `backend` key in its settings:
+
+```yaml
+- step: TextRecognition
+  settings:
+    model: TrOCR
+    backend: int8
+    model_settings:
+      model: Riksarkivet/trocr-base-handwritten-hist-swe-2
+```
+
+Supported backends:
+
+- `pytorch`: the unmodified fp32 model (default)
+- `int8`: dynamically int8-quantized linear layers (TrOCR)
+- `onnx`: ONNX Runtime (TrOCR via optimum, YOLO via the ultralytics exporter)
+- `openvino`: OpenVINO (YOLO via the ultralytics exporter)
+
+Converted models are cached on disk under BACKEND_CACHE_DIR, so the
+conversion only runs the first time a model is used with a backend. The
+optimized backends run on CPU; steps whose model is on a GPU keep using
+PyTorch.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import torch
+from htrflow.models.huggingface.trocr import TrOCR
+from htrflow.models.ultralytics.yolo import YOLO
+from htrflow.pipeline.steps import PipelineStep
+from ultralytics import YOLO as UltralyticsYOLO
+
+logger = logging.getLogger(__name__)
+
+PYTORCH = "pytorch"
+INT8 = "int8"
+ONNX = "onnx"
+OPENVINO = "openvino"
+
+SUPPORTED_BACKENDS = {
+    TrOCR: (PYTORCH, INT8, ONNX),
+    YOLO: (PYTORCH, ONNX, OPENVINO),
+}
+
+# Directory of converted models
+BACKEND_CACHE_DIR = os.environ.get("BACKEND_CACHE_DIR", ".htrflow_cache/backends")
+
+# Backend of steps that run on CPU and do not select a backend themselves
+CPU_BACKEND = os.environ.get("CPU_BACKEND", PYTORCH)
+
+
+def pop_backend(settings: dict) -> tuple[dict, str | None]:
+    """
+    Split the backend from a step's settings.
+
+    Returns:
+        A copy of the settings without the `backend` key, and the selected
+        backend (None if the step does not select one)
+    """
+    settings = dict(settings)
+    backend = settings.pop("backend", None)
+    return settings, backend.lower() if backend else None
+
+
+def _artifact_dir(model, backend: str) -> str:
+    """Cache directory of a model converted to backend, per model revision."""
+    name = str(model.metadata.get("model")).replace("/", "--")
+    version = model.metadata.get("model_version") or "unversioned"
+    return os.path.join(BACKEND_CACHE_DIR, backend, name, version)
+
+
+def _trocr_int8(model: TrOCR, artifact_dir: str) -> str:
+    # Only the quantized weights are cached. The module is quantized again
+    # on load, so the cache never needs to be unpickled.
+    path = os.path.join(artifact_dir, "state_dict.pt")
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    if os.path.exists(path):
+        quantized.load_state_dict(torch.load(path, weights_only=True))
+    else:
+        os.makedirs(artifact_dir, exist_ok=True)
+        torch.save(quantized.state_dict(), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    quantized.eval()
+    model.model = quantized
+    model.compute_transition_scores = quantized.decoder.compute_transition_scores
+    return path
+
+
+def _trocr_onnx(model: TrOCR, artifact_dir: str) -> str:
+    try:
+        from optimum.onnxruntime import ORTModelForVision2Seq
+    except ImportError as e:
+        raise ImportError(
+            "The onnx backend for TrOCR requires optimum with ONNX Runtime: "
+            "pip install 'optimum[onnxruntime]'"
+        ) from e
+
+    if not os.path.exists(os.path.join(artifact_dir, "config.json")):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Export the weights that are already loaded, so the exported
+            # model matches the configured model revision
+            model.model.save_pretrained(os.path.join(tmp_dir, "pytorch"))
+            exported = ORTModelForVision2Seq.from_pretrained(
+                os.path.join(tmp_dir, "pytorch"), export=True
+            )
+            exported.save_pretrained(os.path.join(tmp_dir, "onnx"))
+            os.makedirs(os.path.dirname(artifact_dir), exist_ok=True)
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            shutil.move(os.path.join(tmp_dir, "onnx"), artifact_dir)
+
+    ort_model = ORTModelForVision2Seq.from_pretrained(artifact_dir)
+    model.model = ort_model
+    model.compute_transition_scores = ort_model.compute_transition_scores
+    return artifact_dir
+
+
+def _yolo_export(model: YOLO, backend: str, artifact_dir: str) -> str:
+    name = "model.onnx" if backend == ONNX else "model_openvino_model"
+    path = os.path.join(artifact_dir, name)
+    task = model.model.task
+
+    if not os.path.exists(path):
+        # The exporter writes next to the .pt weights
+        exported = model.model.export(
+            format=backend, dynamic=backend == ONNX, device="cpu"
+        )
+        os.makedirs(artifact_dir, exist_ok=True)
+        shutil.move(str(exported), path)
+
+    model.model = UltralyticsYOLO(path, task=task)
+    return path
+
+
+def apply_backend(step: PipelineStep, backend: str | None):
+    """
+    Switch the model of an inference step to another backend.
+
+    The step's model must be loaded. Steps without a TrOCR or YOLO model
+    are left unchanged.
+
+    Args:
+        step: An initialized pipeline step
+        backend: The backend selected in the step settings, or None to use
+            CPU_BACKEND
+
+    Raises:
+        ValueError: If the model does not support the selected backend
+    """
+    model = getattr(step, "model", None)
+    model_class = next(
+        (cls for cls in SUPPORTED_BACKENDS if isinstance(model, cls)), None
+    )
+    if model_class is None:
+        if backend not in (None, PYTORCH):
+            raise ValueError(f"{step} does not support the backend '{backend}'")
+        return
+
+    if backend is None:
+        backend = CPU_BACKEND
+        if backend not in SUPPORTED_BACKENDS[model_class]:
+            return
+
+    if backend not in SUPPORTED_BACKENDS[model_class]:
+        raise ValueError(
+            f"{model_class.__name__} does not support the backend '{backend}'. "
+            f"Supported backends: {', '.join(SUPPORTED_BACKENDS[model_class])}"
+        )
+    if backend == PYTORCH:
+        return
+
+    if model.device.type != "cpu":
+        logger.warning(
+            "%s runs on %s, ignoring the CPU backend '%s'", step, model.device, backend
+        )
+        return
+
+    artifact_dir = _artifact_dir(model, backend)
+    if model_class is TrOCR:
+        if backend == INT8:
+            artifact = _trocr_int8(model, artifact_dir)
+        else:
+            artifact = _trocr_onnx(model, artifact_dir)
+    else:
+        artifact = _yolo_export(model, backend, artifact_dir)
+
+    model.metadata["backend"] = backend
+    model.metadata["backend_artifact"] = artifact
+    logger.info("%s: using the %s backend (%s)", step, backend, artifact)
+
+
+def artifact_size(model) -> int | None:
+    """
+    On-disk size of the converted model a step runs, in bytes.
+
+    Converted models are not (fully) made of torch parameters: ONNX and
+    OpenVINO models live outside torch, and int8 weights are packed into
+    opaque params. Their cached artifact is used as the memory estimate.
+
+    Returns:
+        The size, or None if the model was not converted to another backend
+    """
+    metadata = getattr(model, "metadata", None) or {}
+    path = metadata.get("backend_artifact")
+    if path is None:
+        return None
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _dirs, files in os.walk(path)
+        for file in files
+    )
@@ -0,0 +1,171 @@
+"""
+Cross-request micro-batching of HTR jobs.
+
+Jobs that use the same pipeline config and arrive within a short window are
+merged into a single collection run, so that the model batch sizes
+(`generation_settings.batch_size`) are filled even when every job is a single
+snippet. The merged result is split back per job afterwards.
+"""
+
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+from htrflow.volume.volume import Collection
+
+from app.collection_utils import split_collection
+from app.step_cache import config_hash
+
+logger = logging.getLogger(__name__)
+
+# How long (in ms) the first job of a batch waits for other jobs with the
+# same pipeline config. 0 disables batching.
+BATCH_WINDOW_MS = int(os.environ.get("BATCH_WINDOW_MS", 0))
+
+# A batch is started early once it holds this many images
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", 32))
+
+
+@dataclass
+class _Job:
+    images: list[str]
+    on_pages: Callable | None = None
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Collection | None = None
+    error: BaseException | None = None
+
+
+@dataclass
+class _Batch:
+    jobs: list[_Job] = field(default_factory=list)
+    full: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def n_images(self) -> int:
+        return sum(len(job.images) for job in self.jobs)
+
+
+class MicroBatcher:
+    """
+    Merge concurrent jobs with identical pipeline configs into one run.
+
+    The first job for a config becomes the leader of a new batch. It waits
+    up to `window` seconds (or until the batch holds `max_images` images),
+    closes the batch and runs all collected images in one pipeline run.
+    The other jobs in the batch block until the leader has split the
+    result back per job.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[..., Collection],
+        window: float = BATCH_WINDOW_MS / 1000,
+        max_images: int = BATCH_MAX_IMAGES,
+    ):
+        """
+        Args:
+            run_batch: Function that runs a pipeline config on a list of
+                images, called as
+                `run_batch(config, images, progress=..., on_pages=...)`
+            window: Maximum time (in seconds) to wait for more jobs
+            max_images: Number of images that closes a batch early
+        """
+        self.run_batch = run_batch
+        self.window = window
+        self.max_images = max_images
+        self._pending: dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, config: dict, images: list[str], progress=None, on_pages=None
+    ) -> Collection:
+        """
+        Run `config` on `images`, possibly batched with other jobs.
+
+        Args:
+            config: Pipeline config (the parsed YAML)
+            images: Paths or URLs of the images of this job
+            progress: Optional Gradio progress tracker. Only the progress
+                of the batch leader is updated.
+            on_pages: Optional callback that receives the finished pages of
+                this job before the whole batch is done
+
+        Returns:
+            A collection with the pages of this job
+        """
+        if self.window <= 0:
+            return self.run_batch(config, images, progress=progress, on_pages=on_pages)
+
+        key = config_hash(config)
+        job = _Job(list(images), on_pages)
+
+        with self._lock:
+            batch = self._pending.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending[key] = _Batch()
+            batch.jobs.append(job)
+            if batch.n_images >= self.max_images:
+                batch.full.set()
+
+        if is_leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            self._run(config, batch, progress)
+        else:
+            job.done.wait()
+
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, config: dict, batch: _Batch, progress):
+        images = [image for job in batch.jobs for image in job.images]
+        logger.info(
+            "Running batch of %d job(s) with %d image(s)", len(batch.jobs), len(images)
+        )
+        try:
+            collection = self.run_batch(
+                config, images, progress=progress, on_pages=_page_router(batch.jobs)
+            )
+            groups = [job.images for job in batch.jobs]
+            for job, result in zip(batch.jobs, split_collection(collection, groups)):
+                job.result = result
+        except BaseException as e:
+            for job in batch.jobs:
+                job.error = e
+        finally:
+            for job in batch.jobs:
+                job.done.set()
+
+
+def _page_router(jobs: list[_Job]) -> Callable | None:
+    """
+    Build a callback that passes finished pages of a batch on to their jobs.
+
+    Pages are matched to jobs by their path, like in `split_collection`.
+    """
+    if not any(job.on_pages for job in jobs):
+        return None
+
+    owners = defaultdict(deque)
+    for job in jobs:
+        for image in job.images:
+            owners[image].append(job)
+
+    def on_pages(pages):
+        pages_by_job = defaultdict(list)
+        for page in pages:
+            if owners[page.path]:
+                job = owners[page.path].popleft()
+                pages_by_job[id(job)].append(page)
+        for job in jobs:
+            if job.on_pages and pages_by_job[id(job)]:
+                job.on_pages(pages_by_job[id(job)])
+
+    return on_pages
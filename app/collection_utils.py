@@ -0,0 +1,167 @@
+"""
+Helpers for splitting, recombining and persisting HTRflow collections.
+"""
+
+import copy
+import os
+import pickle
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Sequence
+
+from htrflow.utils import imgproc
+from htrflow.volume.volume import Collection, PageNode
+from PIL import Image
+
+from app.fetch import local_source
+
+# EXIF orientations that rotate the image by 90 or 270 degrees
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def subset_collection(collection: Collection, pages: Sequence[PageNode]) -> Collection:
+    """
+    Create a collection that holds only the given pages.
+
+    The new collection is a shallow copy of `collection` (same label and
+    attributes) whose page list is replaced by `pages`.
+    """
+    subset = copy.copy(collection)
+    subset.pages = list(pages)
+    return subset
+
+
+def split_collection(
+    collection: Collection, groups: Sequence[Sequence[str]]
+) -> list[Collection]:
+    """
+    Split a collection into one collection per group of image paths.
+
+    Pages are matched to groups by their path, so a path that occurs in
+    several groups is matched to one page per occurrence. Each resulting
+    collection keeps the page order of the input collection.
+
+    Args:
+        collection: Collection created from the concatenation of all groups
+        groups: The image paths of each group
+
+    Returns:
+        One collection per group, in the order of `groups`
+    """
+    available = defaultdict(deque)
+    for page in collection.pages:
+        available[page.path].append(page)
+    order = {id(page): i for i, page in enumerate(collection.pages)}
+
+    subsets = []
+    for paths in groups:
+        pages = [available[path].popleft() for path in paths if available[path]]
+        pages.sort(key=lambda page: order[id(page)])
+        subsets.append(subset_collection(collection, pages))
+    return subsets
+
+
+@contextmanager
+def images_detached(collection: Collection):
+    """
+    Temporarily detach the cached images of all nodes in a collection.
+
+    Nodes cache their decoded images, which would otherwise be included
+    when the collection is pickled. The images are restored on exit.
+    """
+    detached = []
+    for page in collection.pages:
+        for node in page.traverse():
+            image = getattr(node, "_image", None)
+            if image is not None:
+                detached.append((node, image))
+                node._image = None
+    try:
+        yield collection
+    finally:
+        for node, image in detached:
+            node._image = image
+
+
+def dumps_collection(collection: Collection) -> bytes:
+    """Pickle a collection without its cached images."""
+    with images_detached(collection):
+        return pickle.dumps(collection)
+
+
+def loads_collection(data: bytes) -> Collection:
+    """Unpickle a collection pickled with `dumps_collection`."""
+    collection = pickle.loads(data)
+    if not isinstance(collection, Collection):
+        raise pickle.UnpicklingError("Unpickling did not return a Collection instance.")
+    return collection
+
+
+def rebind_page(page: PageNode, path: str) -> PageNode:
+    """
+    Point a page at another copy of its image.
+
+    Used when a page processed from one file is reused for an identical
+    image at another path. Updates the page's path, label and file
+    metadata and relabels its nodes.
+    """
+    label = os.path.splitext(os.path.basename(path))[0]
+    page.path = path
+    page._label = label
+    page._image = None
+    page.add_data(
+        file_name=os.path.basename(path),
+        image_path=path,
+        image_name=label,
+    )
+    page.relabel()
+    return page
+
+
+def page_size(page: PageNode) -> tuple[int, int]:
+    """
+    Get the (width, height) of a page without caching its image.
+
+    `page.width` and `page.height` decode the page image and keep it on the
+    node. For pages whose image has been released (see
+    `PipelineWithProgress.run_chunked`), the size is read from the image
+    header instead, so that iterating over a large collection does not load
+    every page image back into memory.
+    """
+    if page._image is not None:
+        height, width = page._image.shape[:2]
+        return width, height
+
+    source = local_source(page.path)
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+        return width, height
+    except Exception:
+        height, width = imgproc.read(source).shape[:2]
+        return width, height
+
+
+def save_collection(collection: Collection, path: str) -> str:
+    """
+    Pickle a collection without its cached images.
+
+    The file is written atomically, so an interrupted write never leaves a
+    truncated pickle at `path`.
+
+    Returns:
+        The path to the pickled collection
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with images_detached(collection), open(tmp_path, "wb") as f:
+        pickle.dump(collection, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_collection(path: str) -> Collection:
+    """Load a collection pickled with `save_collection`."""
+    return Collection.from_pickle(path)
@@ -0,0 +1,347 @@
+"""
+Concurrent download of remote images.
+
+Images given by URL (image IDs, IIIF images, image URLs and MCP
+`image_urls`) are otherwise downloaded by HTRflow one at a time, each with a
+new connection, while the job holds its slot. `prefetch` downloads all
+remote images of a job up front with a pycurl multi handle: a bounded number
+of transfers run in parallel, connections are kept alive and reused between
+transfers, and DNS lookups and TLS sessions are shared by all handles of
+the process.
+
+Downloaded files are named after the hash of their URL, so any process can
+find them with `local_source` without the URL being rewritten. The pages of
+a collection keep their URLs as paths.
+
+The download directory is a persistent HTTP cache shared by image and
+manifest fetches. A cached response is used as is for a while after it was
+last validated, then revalidated with its ETag or Last-Modified date, so
+that repeat requests for the same archive page cost at most a 304 response.
+The least recently used files are removed once the cache exceeds its size
+limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import certifi
+import pycurl
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of parallel image downloads per job
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 8))
+
+# Directory of downloaded images
+FETCH_DIR = os.environ.get("FETCH_DIR", ".htrflow_cache/downloads")
+
+# Timeout in seconds for downloading one image
+FETCH_TIMEOUT = int(os.environ.get("FETCH_TIMEOUT", 60))
+
+# Size limit of the download cache. The least recently used files are
+# removed first.
+FETCH_CACHE_MAX_MB = int(os.environ.get("FETCH_CACHE_MAX_MB", 4096))
+
+# Cached responses are used without revalidation for this many seconds after
+# they were last validated with the server
+FETCH_CACHE_FRESH_SECONDS = int(os.environ.get("FETCH_CACHE_FRESH_SECONDS", 3600))
+
+_IMAGE_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".tif",
+    ".tiff",
+    ".webp",
+    ".jp2",
+    ".gif",
+    ".bmp",
+}
+
+_share = None
+_share_lock = threading.Lock()
+
+
+def _curl_share() -> pycurl.CurlShare:
+    """Process-wide share handle for DNS lookups and TLS sessions."""
+    global _share
+    with _share_lock:
+        if _share is None:
+            _share = pycurl.CurlShare()
+            _share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            _share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        return _share
+
+
+def curl_handle(timeout: int = FETCH_TIMEOUT) -> pycurl.Curl:
+    """Create a curl handle with the common options, sharing DNS and TLS state."""
+    c = pycurl.Curl()
+    c.setopt(c.SHARE, _curl_share())
+    c.setopt(c.CAINFO, certifi.where())
+    c.setopt(c.FOLLOWLOCATION, 1)
+    c.setopt(c.MAXREDIRS, 5)
+    c.setopt(c.CONNECTTIMEOUT, 5)
+    c.setopt(c.TIMEOUT, timeout)
+    c.setopt(c.NOSIGNAL, 1)
+    c.setopt(c.USERAGENT, "curl/7.68.0")
+    return c
+
+
+def is_remote(source: str) -> bool:
+    return isinstance(source, str) and source.startswith(("http://", "https://"))
+
+
+def download_path(url: str) -> str:
+    """Path of the downloaded file of url."""
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return os.path.join(FETCH_DIR, name + (ext if ext in _IMAGE_EXTENSIONS else ""))
+
+
+def local_source(source: str) -> str:
+    """The downloaded file of a remote image, if it has been prefetched, else source."""
+    if is_remote(source):
+        path = download_path(source)
+        if os.path.exists(path):
+            return path
+    return source
+
+
+def _meta_path(path: str) -> str:
+    return f"{path}.meta"
+
+
+def _read_meta(path: str) -> dict:
+    try:
+        with open(_meta_path(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(path: str, meta: dict):
+    tmp_path = f"{_meta_path(path)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, _meta_path(path))
+
+
+def cached_file(url: str, max_age: int = FETCH_CACHE_FRESH_SECONDS) -> str | None:
+    """
+    The cached response body of url, if it can be used without a request.
+
+    That is the case if it was validated with the server within max_age
+    seconds. The file is marked as recently used.
+    """
+    path = download_path(url)
+    meta = _read_meta(path)
+    if not os.path.exists(path) or time.time() - meta.get("validated", 0) > max_age:
+        return None
+    os.utime(path)
+    return path
+
+
+def request_headers(url: str) -> list[str]:
+    """Conditional request headers that revalidate the cached response of url."""
+    path = download_path(url)
+    if not os.path.exists(path):
+        return []
+    meta = _read_meta(path)
+    headers = []
+    if meta.get("etag"):
+        headers.append(f"If-None-Match: {meta['etag']}")
+    if meta.get("last_modified"):
+        headers.append(f"If-Modified-Since: {meta['last_modified']}")
+    return headers
+
+
+class ResponseHeaders:
+    """Collects the validators of a response, for use as a pycurl HEADERFUNCTION."""
+
+    def __init__(self):
+        self.status = None
+        self.etag = None
+        self.last_modified = None
+
+    def __call__(self, line: bytes):
+        line = line.decode("iso-8859-1").strip()
+        if line.upper().startswith("HTTP/"):
+            # Status line of a new response, e.g. after a redirect
+            self.etag = self.last_modified = None
+            parts = line.split()
+            self.status = (
+                int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            )
+            return
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        if name == "etag":
+            self.etag = value.strip()
+        elif name == "last-modified":
+            self.last_modified = value.strip()
+
+
+def store_response(url: str, tmp_path: str, headers: ResponseHeaders) -> str:
+    """Move a downloaded response body into the cache."""
+    path = download_path(url)
+    os.replace(tmp_path, path)
+    _write_meta(
+        path,
+        {
+            "url": url,
+            "etag": headers.etag,
+            "last_modified": headers.last_modified,
+            "validated": time.time(),
+        },
+    )
+    return path
+
+
+def mark_validated(url: str, headers: ResponseHeaders) -> str:
+    """Record that the cached response of url was confirmed by a 304 response."""
+    path = download_path(url)
+    meta = _read_meta(path)
+    meta["validated"] = time.time()
+    # A 304 response may carry updated validators
+    meta["etag"] = headers.etag or meta.get("etag")
+    meta["last_modified"] = headers.last_modified or meta.get("last_modified")
+    _write_meta(path, meta)
+    os.utime(path)
+    return path
+
+
+def evict(keep: set[str] = frozenset(), max_bytes: int = FETCH_CACHE_MAX_MB * 1024**2):
+    """Remove the least recently used cached files until the cache fits max_bytes."""
+    files = []
+    try:
+        entries = list(os.scandir(FETCH_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.endswith((".meta", ".tmp")):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((entry.path, stat.st_mtime, stat.st_size))
+
+    total_bytes = sum(size for _, _, size in files)
+    for path, _, size in sorted(files, key=lambda file: file[1]):
+        if total_bytes <= max_bytes:
+            break
+        if path in keep:
+            continue
+        for file in (path, _meta_path(path)):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        total_bytes -= size
+
+
+def _start(multi: pycurl.CurlMulti, c: pycurl.Curl, url: str):
+    path = download_path(url)
+    c.url = url
+    c.tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    c.file = open(c.tmp_path, "wb")
+    c.headers = ResponseHeaders()
+    c.setopt(c.URL, url)
+    c.setopt(c.WRITEDATA, c.file)
+    c.setopt(c.HEADERFUNCTION, c.headers)
+    c.setopt(c.HTTPHEADER, request_headers(url))
+    multi.add_handle(c)
+
+
+def _finish(multi: pycurl.CurlMulti, c: pycurl.Curl, error: str | None) -> bool:
+    multi.remove_handle(c)
+    c.file.close()
+    http_code = c.getinfo(c.RESPONSE_CODE) if error is None else None
+    if http_code == 200:
+        store_response(c.url, c.tmp_path, c.headers)
+        return True
+
+    os.remove(c.tmp_path)
+    if http_code == 304:
+        mark_validated(c.url, c.headers)
+        return True
+    logger.warning(
+        "Could not download %s (%s)", c.url, error or f"HTTP Error: {http_code}"
+    )
+    return False
+
+
+def prefetch(urls: list[str], concurrency: int = FETCH_CONCURRENCY) -> dict[str, str]:
+    """
+    Download remote images concurrently.
+
+    Cached images are used without a request while they are fresh and are
+    revalidated with a conditional request otherwise (see `cached_file`).
+    Failed downloads are logged and left to HTRflow, which reports them as
+    unreadable images.
+
+    Args:
+        urls: Image URLs; other sources are ignored
+        concurrency: Maximum number of parallel transfers
+
+    Returns:
+        A mapping from each successfully downloaded URL to its local file
+    """
+    urls = list(dict.fromkeys(url for url in urls if is_remote(url)))
+    pending = deque(url for url in urls if cached_file(url) is None)
+    if not pending:
+        return {url: download_path(url) for url in urls}
+
+    os.makedirs(FETCH_DIR, exist_ok=True)
+    start = time.perf_counter()
+    n_pending = len(pending)
+    multi = pycurl.CurlMulti()
+    handles = [curl_handle() for _ in range(min(max(concurrency, 1), len(pending)))]
+    idle = list(handles)
+    n_failed = 0
+
+    try:
+        while pending or len(idle) < len(handles):
+            while pending and idle:
+                _start(multi, idle.pop(), pending.popleft())
+
+            while True:
+                ret, _ = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                n_queued, succeeded, failed = multi.info_read()
+                finished = [(c, None) for c in succeeded]
+                finished += [(c, error_msg) for c, _, error_msg in failed]
+                for c, error_msg in finished:
+                    n_failed += not _finish(multi, c, error_msg)
+                    idle.append(c)
+                if n_queued == 0:
+                    break
+
+            if len(idle) < len(handles):
+                multi.select(1.0)
+    finally:
+        for c in handles:
+            if c not in idle:
+                _finish(multi, c, "Interrupted")
+            c.close()
+        multi.close()
+
+    logger.info(
+        "Fetched %d image(s) in %.2fs with %d connection(s), %d failed, %d cached",
+        n_pending - n_failed,
+        time.perf_counter() - start,
+        len(handles),
+        n_failed,
+        len(urls) - n_pending,
+    )
+    evict(keep={download_path(url) for url in urls})
+    return {url: path for url in urls if os.path.exists(path := download_path(url))}
@@ -0,0 +1,39 @@
+"""
+Liveness and readiness endpoints for load balancers.
+
+These are plain HTTP routes mounted next to the Gradio app, so they can be
+probed without going through the Gradio queue.
+"""
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from app.warmup import is_ready, warmup_status
+
+
+def liveness(request: Request) -> PlainTextResponse:
+    """The process is up and serving requests."""
+    return PlainTextResponse("ok")
+
+
+def readiness(request: Request) -> JSONResponse:
+    """
+    Report which pipelines are warm.
+
+    Responds with 200 once the model warm-up has finished and 503 while it
+    is still running, together with the status of each pipeline. Pipelines
+    whose models the step cache has evicted since are reported as evicted,
+    without affecting the status code.
+    """
+    ready = is_ready()
+    return JSONResponse(
+        {"ready": ready, "pipelines": warmup_status()},
+        status_code=200 if ready else 503,
+    )
+
+
+HEALTH_ROUTES = [
+    Route("/healthz", liveness, methods=["GET"]),
+    Route("/readyz", readiness, methods=["GET"]),
+]
@@ -0,0 +1,490 @@
+"""
+IIIF Presentation API v2/v3 manifests and Image API size negotiation.
+
+Manifests are parsed incrementally while they are downloaded: the canvases
+(v2 `sequences[0].canvases`, v3 `items`) are emitted one at a time in
+document order, and the download is stopped as soon as the selected canvas
+range has been read. Large volumes with thousands of canvases therefore
+never have to be held in memory as a whole.
+
+IIIF images are requested at the size they are used at: thumbnails for the
+galleries, a screen-sized image for the Results tab, and the resolution the
+pipeline needs for inference. The sizes are negotiated with the `info.json`
+of each image service, which tells the image dimensions, the sizes a
+level 0 server offers, and the server's size limits.
+"""
+
+import codecs
+import json
+import logging
+import os
+import re
+import threading
+
+import pycurl
+
+from app.fetch import (
+    ResponseHeaders,
+    cached_file,
+    curl_handle,
+    download_path,
+    evict,
+    local_source,
+    mark_validated,
+    prefetch,
+    request_headers,
+    store_response,
+)
+from app.page_ranges import in_ranges, parse_ranges, ranges_end
+from app.preprocessing import page_side
+
+logger = logging.getLogger(__name__)
+
+# Long side of the IIIF images shown in the galleries
+IIIF_THUMBNAIL_SIDE = int(os.environ.get("IIIF_THUMBNAIL_SIDE", 512))
+
+# Long side of the IIIF images shown in the Results tab
+IIIF_DISPLAY_SIDE = int(os.environ.get("IIIF_DISPLAY_SIDE", 2048))
+
+# Long side of the IIIF images downloaded for inference, for pipelines that
+# do not set `image_max_side`. 0 requests the full resolution.
+IIIF_INFERENCE_SIDE = int(os.environ.get("IIIF_INFERENCE_SIDE", 0))
+
+# Paths of the canvas arrays in v2 and v3 manifests (None matches any index)
+_CANVAS_PATHS = (("sequences", 0, "canvases", None), ("items", None))
+
+_TOKEN = re.compile(r'["{}\[\],:]')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+
+
+class ManifestParser:
+    """
+    Incremental parser that extracts the canvases of a manifest.
+
+    Feed the manifest text in chunks of any size with `feed`; each call
+    returns the canvases that were completed by the chunk. Only the text
+    of the canvas currently being read is buffered.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        # One entry per open container: [is_object, key or index, expecting_key]
+        self._stack: list[list] = []
+        self._capture_start: int | None = None
+        self._capture_depth = 0
+        self.n_canvases = 0
+
+    def _path(self) -> tuple:
+        return tuple(entry[1] for entry in self._stack)
+
+    def _at_canvas(self) -> bool:
+        path = self._path()
+        for pattern in _CANVAS_PATHS:
+            if len(path) == len(pattern) and all(
+                p is None or p == q for p, q in zip(pattern, path)
+            ):
+                return True
+        return False
+
+    def feed(self, text: str) -> list[dict]:
+        """
+        Parse the next chunk of the manifest.
+
+        Returns:
+            The canvases completed in this chunk, in document order
+
+        Raises:
+            ValueError: If the text is not well-formed JSON
+        """
+        self._buffer += text
+        canvases = []
+        buffer = self._buffer
+        pos = self._pos
+
+        while True:
+            match = _TOKEN.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            char = match.group()
+            start = match.start()
+
+            if char == '"':
+                string = _STRING.match(buffer, start)
+                if string is None:
+                    # The string continues in the next chunk
+                    pos = start
+                    break
+                pos = string.end()
+                top = self._stack[-1] if self._stack else None
+                if top is not None and top[0] and top[2]:
+                    top[1] = json.loads(string.group())
+                    top[2] = False
+                continue
+
+            pos = start + 1
+            if char in "{[":
+                if self._capture_start is None and char == "{" and self._at_canvas():
+                    self._capture_start = start
+                    self._capture_depth = len(self._stack)
+                self._stack.append(
+                    [char == "{", None if char == "{" else 0, char == "{"]
+                )
+            elif char in "}]":
+                if not self._stack or self._stack[-1][0] != (char == "}"):
+                    raise ValueError("Not a IIIF manifest")
+                self._stack.pop()
+                if (
+                    self._capture_start is not None
+                    and len(self._stack) == self._capture_depth
+                ):
+                    canvases.append(json.loads(buffer[self._capture_start : pos]))
+                    self.n_canvases += 1
+                    self._capture_start = None
+            elif char == "," and self._stack:
+                top = self._stack[-1]
+                if top[0]:
+                    top[2] = True
+                else:
+                    top[1] += 1
+
+        # Drop the text that is no longer needed
+        keep = pos if self._capture_start is None else self._capture_start
+        self._buffer = buffer[keep:]
+        self._pos = pos - keep
+        if self._capture_start is not None:
+            self._capture_start -= keep
+        return canvases
+
+
+def _first(value):
+    return value[0] if isinstance(value, list) and value else value
+
+
+def _service_id(service) -> str | None:
+    service = _first(service)
+    if isinstance(service, dict):
+        return service.get("@id") or service.get("id")
+    return None
+
+
+def canvas_label(canvas: dict) -> str:
+    """The label of a canvas (v2 string or v3 language map)."""
+    label = canvas.get("label")
+    if isinstance(label, dict):
+        label = _first(next(iter(label.values()), None))
+    if isinstance(label, list):
+        label = _first(label)
+        if isinstance(label, dict):
+            label = label.get("@value")
+    return str(label) if label else ""
+
+
+def canvas_image(canvas: dict) -> tuple[str | None, str | None]:
+    """
+    Find the image of a canvas.
+
+    Returns:
+        The base URL of the image's IIIF Image API service (None if it has
+        none) and the URL of the image resource itself
+    """
+    if "images" in canvas:
+        # v2: canvas.images[].resource
+        annotation = _first(canvas["images"]) or {}
+        resource = annotation.get("resource") or {}
+    else:
+        # v3: canvas.items[] (annotation pages) .items[] (annotations) .body
+        page = _first(canvas.get("items")) or {}
+        annotation = _first(page.get("items")) or {}
+        resource = _first(annotation.get("body")) or {}
+        if resource.get("type") == "Choice":
+            resource = _first(resource.get("items")) or {}
+
+    service = _service_id(resource.get("service"))
+    return (service.rstrip("/") if service else None), resource.get(
+        "@id"
+    ) or resource.get("id")
+
+
+def iiif_image_url(service: str, size: str = "max", format_: str = "jpg") -> str:
+    """URL of a full image from its Image API service at the given IIIF size."""
+    return f"{service}/full/{size}/0/default.{format_}"
+
+
+_IMAGE_URL = re.compile(
+    r"(?P<service>https?://.+?)/(?P<region>full|square|pct:[\d.,]+|\d+,\d+,\d+,\d+)"
+    r"/(?P<size>[^/]+)/(?P<rotation>!?[\d.]+)/(?P<quality>\w+)\.(?P<format>\w+)"
+)
+
+_LEVEL = re.compile(r"level(\d)")
+
+
+def parse_image_url(url: str) -> dict | None:
+    """Split an Image API URL into its service and parameters, or None if it is not one."""
+    match = _IMAGE_URL.fullmatch(url) if isinstance(url, str) else None
+    return match.groupdict() if match else None
+
+
+def info_url(service: str) -> str:
+    return f"{service}/info.json"
+
+
+def fetch_infos(services: list[str]):
+    """Download the info.json of several image services concurrently (see `app.fetch.prefetch`)."""
+    prefetch([info_url(service) for service in services])
+
+
+def load_info(service: str) -> dict | None:
+    """The info.json of an image service, downloaded if it is not cached."""
+    url = info_url(service)
+    path = local_source(url)
+    if path == url:
+        path = prefetch([url]).get(url)
+    if path is None:
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _compliance_level(info: dict) -> int:
+    profile = info.get("profile")
+    for item in profile if isinstance(profile, list) else [profile]:
+        match = _LEVEL.search(item) if isinstance(item, str) else None
+        if match:
+            return int(match.group(1))
+    return 2
+
+
+def _max_width(info: dict) -> int | None:
+    # v3 has the limits on the info, v2 on the profile description
+    profile = info.get("profile")
+    limits = [info]
+    if isinstance(profile, list):
+        limits += [item for item in profile if isinstance(item, dict)]
+    return next((item["maxWidth"] for item in limits if "maxWidth" in item), None)
+
+
+def negotiate_size(info: dict, max_side: int) -> str:
+    """
+    The size parameter that requests an image scaled to a long side of max_side.
+
+    Images are never upscaled. Level 0 servers only offer the sizes listed in
+    the info.json; the smallest listed size that is large enough is used.
+
+    Args:
+        info: The info.json of the image service
+        max_side: Requested long side, or 0 for the full resolution
+    """
+    version3 = "image/3" in str(info.get("@context", ""))
+    full = "max" if version3 else "full"
+    width, height = info.get("width"), info.get("height")
+    if not max_side or not width or not height or max(width, height) <= max_side:
+        return full
+
+    factor = max_side / max(width, height)
+    target_width = max(round(width * factor), 1)
+
+    if _compliance_level(info) == 0:
+        sizes = sorted(info.get("sizes") or [], key=lambda size: size["width"])
+        if not sizes:
+            return full
+        size = next(
+            (size for size in sizes if size["width"] >= target_width), sizes[-1]
+        )
+        return f"{size['width']},{size['height']}" if version3 else f"{size['width']},"
+
+    max_width = _max_width(info)
+    if max_width:
+        target_width = min(target_width, max_width)
+    return f"{target_width},"
+
+
+def sized_image_url(url: str, max_side: int) -> str:
+    """
+    Rewrite a full-image IIIF URL to request the image at max_side.
+
+    URLs that are not full IIIF images, and images whose info.json cannot be
+    read, are returned unchanged.
+
+    Args:
+        url: An image URL
+        max_side: Requested long side, or 0 for the full resolution
+    """
+    parts = parse_image_url(url)
+    if parts is None or parts["region"] != "full":
+        return url
+    info = load_info(parts["service"])
+    if info is None:
+        return url
+    size = negotiate_size(info, max_side)
+    return f"{parts['service']}/full/{size}/{parts['rotation']}/{parts['quality']}.{parts['format']}"
+
+
+def sized_image_urls(urls: list[str], max_side: int) -> list[str]:
+    """Like `sized_image_url` for several URLs, with the info.json files fetched concurrently."""
+    services = [parts["service"] for url in urls if (parts := parse_image_url(url))]
+    if services:
+        fetch_infos(services)
+    return [sized_image_url(url, max_side) for url in urls]
+
+
+def display_url(url: str) -> str | None:
+    """URL of a screen-sized copy of a IIIF image, or None if url is not a IIIF image."""
+    if parse_image_url(url) is None:
+        return None
+    return sized_image_url(url, IIIF_DISPLAY_SIDE)
+
+
+def inference_side(config: dict) -> int:
+    """
+    Long side of the IIIF images a pipeline runs on (0 for full resolution).
+
+    The pipeline's own `image_max_side` takes precedence over
+    IIIF_INFERENCE_SIDE. Without either, the images are requested at the
+    resolution cap of the pipeline's inference steps (see
+    `app.preprocessing.page_side`).
+    """
+    if "image_max_side" in config:
+        return int(config["image_max_side"] or 0)
+    return IIIF_INFERENCE_SIDE or page_side(config)
+
+
+def _download_manifest(manifest_url: str, feed) -> str | None:
+    """
+    Download a manifest, or revalidate its cached copy.
+
+    The response body is passed to feed while it is downloaded, and the
+    download is aborted once feed returns True. Bodies of error responses
+    are not passed to feed. Complete downloads are stored in the download
+    cache.
+
+    Returns:
+        The cached manifest file if the cached copy is still valid (and must
+        be parsed by the caller), else None
+
+    Raises:
+        ConnectionError: If the manifest could not be downloaded
+        ValueError: If the response is not a manifest (see `ManifestParser`)
+    """
+    tmp_path = (
+        f"{download_path(manifest_url)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+    headers = ResponseHeaders()
+    done = False
+    parse_error = None
+
+    def write(data: bytes):
+        nonlocal done, parse_error
+        if headers.status is None or not 200 <= headers.status < 300:
+            # Error pages are not manifests; the status is reported below
+            return None
+        body.write(data)
+        try:
+            finished = feed(data)
+        except ValueError as e:
+            # Raised below, since pycurl reports errors in callbacks as
+            # write errors
+            parse_error = e
+            return 0
+        if finished:
+            done = True
+            # Returning a different length than len(data) aborts the transfer
+            return 0
+        return None
+
+    c = curl_handle()
+    c.setopt(c.URL, manifest_url)
+    c.setopt(c.WRITEFUNCTION, write)
+    c.setopt(c.HEADERFUNCTION, headers)
+    c.setopt(c.HTTPHEADER, request_headers(manifest_url))
+    try:
+        with open(tmp_path, "wb") as body:
+            c.perform()
+        http_code = c.getinfo(c.RESPONSE_CODE)
+        if http_code == 304:
+            return mark_validated(manifest_url, headers)
+        if http_code != 200:
+            raise ConnectionError(f"HTTP Error: {http_code}")
+        # Only complete manifests are cached
+        evict(keep={store_response(manifest_url, tmp_path, headers)})
+    except pycurl.error as e:
+        if parse_error is not None:
+            raise parse_error from None
+        if not done:
+            _, error_msg = e.args
+            raise ConnectionError(
+                f"Could not fetch IIIF manifest from {manifest_url} ({error_msg})"
+            ) from e
+    finally:
+        c.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return None
+
+
+def fetch_manifest_canvases(
+    manifest_url: str, canvas_range: str | None = None, max_canvases: int | None = None
+) -> list[tuple[int, dict]]:
+    """
+    Download a manifest and return the selected canvases.
+
+    The manifest is parsed while it is downloaded, and the download is
+    stopped once the last selected canvas has been read. Manifests are
+    cached like images (see `app.fetch`), and parsed from the cached file
+    while it is fresh or after the server confirmed it with a 304 response.
+
+    Args:
+        manifest_url: URL of a v2 or v3 manifest
+        canvas_range: Optional selection of canvases, counted from 1, e.g.
+            "40-80" (see `app.page_ranges.parse_ranges`)
+        max_canvases: Optional maximum number of canvases to return
+
+    Returns:
+        (canvas_number, canvas) tuples in document order
+
+    Raises:
+        ValueError: If the canvas range is malformed or the document is not
+            a manifest
+        ConnectionError: If the manifest could not be downloaded
+    """
+    ranges = parse_ranges(canvas_range)
+    end = ranges_end(ranges)
+    parser = ManifestParser()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    selected = []
+
+    def feed(data: bytes) -> bool:
+        """Parse the next chunk; True once all selected canvases have been read."""
+        canvases = parser.feed(decoder.decode(data))
+        first = parser.n_canvases - len(canvases) + 1
+        for number, canvas in enumerate(canvases, start=first):
+            if in_ranges(number, ranges):
+                selected.append((number, canvas))
+            if (end is not None and number >= end) or (
+                max_canvases and len(selected) >= max_canvases
+            ):
+                return True
+        return False
+
+    path = cached_file(manifest_url)
+    if path is None:
+        path = _download_manifest(manifest_url, feed)
+
+    if path is not None:
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(64 * 1024), b""):
+                if feed(data):
+                    break
+
+    logger.info(
+        "Read %d canvas(es) of manifest %s, selected %d",
+        parser.n_canvases,
+        manifest_url,
+        len(selected),
+    )
+    return selected[:max_canvases] if max_canvases else selected
@@ -0,0 +1,207 @@
+"""
+Job-scoped store of decoded page images.
+
+HTRflow decodes a page image when the page is created, drops it once the
+page is segmented, and decodes it again from the source file whenever a
+later step needs it (the second segmentation pass of a nested pipeline,
+cropping text lines for recognition, exports). For large JPEG and TIFF
+scans, this repeated decoding is a large share of the CPU time of a job.
+
+Within `job_image_store()`, every image is decoded once and written to a
+temporary `.npy` file. Pages created with `new_collection` (and collections
+passed to `attach`) read their image from there, memory-mapped, so all
+steps share one decoded copy that the OS can page out under memory
+pressure. The files of finished pages are removed with `release_images`,
+and chunked jobs use one store per chunk, so the store only holds the pages
+that are being processed.
+"""
+
+import copyreg
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import numpy as np
+from htrflow.utils import imgproc
+from htrflow.volume.volume import Collection, PageNode
+
+from app.fetch import local_source
+
+logger = logging.getLogger(__name__)
+
+# Parent directory of the job image stores. Defaults to the system temp dir.
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR") or None
+
+
+def decode(path: str) -> np.ndarray:
+    """Decode an image, from its prefetched file if it is a downloaded URL."""
+    return imgproc.read(local_source(path))
+
+
+class ImageStore:
+    """Decoded images, memory-mapped from .npy files in a directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.closed = False
+        self._lock = threading.Lock()
+        self._path_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    def _file(self, path: str) -> str:
+        name = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _open(self, file: str) -> np.ndarray:
+        # Copy-on-write, so that in-place operations on the image never
+        # change the stored copy
+        return np.asarray(np.load(file, mmap_mode="c"))
+
+    def put(self, path: str, image: np.ndarray) -> np.ndarray:
+        """
+        Store an already decoded image.
+
+        Returns:
+            The memory-mapped stored image
+        """
+        file = self._file(path)
+        tmp_file = f"{file}.{threading.get_ident()}.tmp.npy"
+        np.save(tmp_file, image)
+        os.replace(tmp_file, file)
+        return self._open(file)
+
+    def get(self, path: str) -> np.ndarray:
+        """
+        Get the decoded image at path, decoding it on the first request.
+
+        Falls back to decoding from the source once the store is closed.
+        """
+        if self.closed:
+            return decode(path)
+
+        file = self._file(path)
+        with self._lock:
+            path_lock = self._path_locks[path]
+        with path_lock:
+            if os.path.exists(file):
+                return self._open(file)
+            return self.put(path, decode(path))
+
+    def discard(self, path: str):
+        """Remove the stored copy of an image. It is decoded again if requested later."""
+        with self._lock:
+            path_lock = self._path_locks.pop(path, None)
+        if path_lock is None:
+            return
+        with path_lock:
+            try:
+                os.remove(self._file(path))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Remove the stored files. Images already handed out stay readable."""
+        self.closed = True
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+_current_store: ContextVar[ImageStore | None] = ContextVar("image_store", default=None)
+
+
+def current_store() -> ImageStore | None:
+    return _current_store.get()
+
+
+@contextmanager
+def job_image_store():
+    """Provide a fresh image store to the enclosed block, removed on exit."""
+    store = ImageStore(tempfile.mkdtemp(prefix="htrflow_images_", dir=IMAGE_STORE_DIR))
+    token = _current_store.set(store)
+    try:
+        yield store
+    finally:
+        _current_store.reset(token)
+        store.close()
+
+
+def read_image(path: str) -> np.ndarray:
+    """Read an image through the current job's store, if there is one."""
+    store = current_store()
+    if store is None:
+        return decode(path)
+    return store.get(path)
+
+
+class StoredPageNode(PageNode):
+    """A page that loads its image from an image store."""
+
+    def __init__(self, image_path: str, store: ImageStore):
+        self._store = store
+        super().__init__(image_path)
+
+    def _load_image(self):
+        store = getattr(self, "_store", None)
+        if store is None:
+            return decode(self.path)
+        return store.get(self.path)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as a plain PageNode without the store, so that pickled
+        # collections stay loadable without this module
+        state = self.__dict__.copy()
+        state.pop("_store", None)
+        state["_image"] = None
+        return copyreg.__newobj__, (PageNode,), state
+
+
+def new_collection(paths: list[str], label: str) -> Collection:
+    """
+    Create a collection whose pages read their images from the current store.
+
+    Like `Collection(paths, label)`, unreadable images are skipped and the
+    pages are sorted by path.
+    """
+    store = current_store()
+    if store is None:
+        return Collection(paths, label=label)
+
+    pages = []
+    for path in sorted(paths):
+        try:
+            pages.append(StoredPageNode(path, store))
+        except imgproc.ImageImportError as e:
+            logger.warning(e)
+    collection = Collection([], label=label)
+    collection.pages = pages
+    return collection
+
+
+def attach(collection: Collection) -> Collection:
+    """Make the pages of an existing collection read their images from the current store."""
+    store = current_store()
+    if store is None:
+        return collection
+
+    for page in collection.pages:
+        if type(page) is PageNode:
+            page.__class__ = StoredPageNode
+        if not isinstance(page, StoredPageNode):
+            continue
+        page._store = store
+        if page._image is not None:
+            page._image = store.put(page.path, page._image)
+    return collection
+
+
+def release_images(pages: list[PageNode]):
+    """Drop the cached images of finished pages and their files in the store."""
+    for page in pages:
+        page.clear_images()
+        store = getattr(page, "_store", None)
+        if store is not None:
+            store.discard(page.path)
@@ -6,19 +6,10 @@ import gradio as gr
 from gradio_i18n import Translate, gettext as _
 
 from app.gradio_config import css, theme
-from app.tabs.submit import (
-    collection_submit_state,
-    submit,
-    pipeline_description,
-    pipeline_dropdown,
-    get_pipeline_description,
-)
-from app.tabs.visualizer import collection as collection_viz_state
-from app.tabs.visualizer import visualizer
-from app.mcp_tools import (
-    # htr_upload_image,
-    htr_transcribe,
-)
+from app.health import HEALTH_ROUTES
+from app.metrics import METRICS_ROUTES
+from app.visualizer_pages import VISUALIZER_ROUTES
+from app.warmup import start_warmup
 
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
@@ -66,105 +57,145 @@ else:
 <!-- End Matomo Code -->
 """
 
-with gr.Blocks(
-    title="HTR-demo",
-) as demo:
-    with Translate("app/translations.yaml", placeholder_langs=["en", "sv"]) as lang:
-        with gr.Row():
-            with gr.Column(scale=20):
-                gr.Markdown(load_markdown(None, "main_title"), elem_classes="title-h1")
-            with gr.Column(scale=1, min_width=80):
-                lang_selector = gr.Dropdown(
-                    choices=[("EN", "en"), ("SV", "sv")],
-                    value="en",
-                    container=False,
-                    show_label=False,
-                )
-
-        lang_selector.change(
-            fn=lambda x: x,
-            inputs=[lang_selector],
-            outputs=[lang],
-            api_visibility="private",
-        )
-
-        with gr.Sidebar(label="Menu"):
-            gr.HTML(load_markdown(None, "main_sub_title_hum"))
-            sidebar_content = gr.Markdown(load_markdown("en", "sidebar"))
 
-        def update_sidebar(language):
-            return load_markdown(language, "sidebar")
+def build_demo() -> gr.Blocks:
+    """
+    Build the Gradio app.
 
-        lang_selector.change(
-            fn=update_sidebar,
-            inputs=[lang_selector],
-            outputs=[sidebar_content],
+    The tabs build their components when they are imported, so they are
+    imported here rather than at module level.
+    """
+    from app.mcp_tools import (
+        # htr_upload_image,
+        htr_transcribe,
+    )
+    from app.tabs.submit import (
+        HTR_CONCURRENCY,
+        collection_submit_state,
+        get_pipeline_description,
+        pipeline_description,
+        pipeline_dropdown,
+        submit,
+    )
+    from app.tabs.visualizer import collection as collection_viz_state
+    from app.tabs.visualizer import visualizer
+
+    with gr.Blocks(
+        title="HTR-demo",
+    ) as demo:
+        with Translate("app/translations.yaml", placeholder_langs=["en", "sv"]) as lang:
+            with gr.Row():
+                with gr.Column(scale=20):
+                    gr.Markdown(
+                        load_markdown(None, "main_title"), elem_classes="title-h1"
+                    )
+                with gr.Column(scale=1, min_width=80):
+                    lang_selector = gr.Dropdown(
+                        choices=[("EN", "en"), ("SV", "sv")],
+                        value="en",
+                        container=False,
+                        show_label=False,
+                    )
+
+            lang_selector.change(
+                fn=lambda x: x,
+                inputs=[lang_selector],
+                outputs=[lang],
+                api_visibility="private",
+            )
+
+            with gr.Sidebar(label="Menu"):
+                gr.HTML(load_markdown(None, "main_sub_title_hum"))
+                sidebar_content = gr.Markdown(load_markdown("en", "sidebar"))
+
+            def update_sidebar(language):
+                return load_markdown(language, "sidebar")
+
+            lang_selector.change(
+                fn=update_sidebar,
+                inputs=[lang_selector],
+                outputs=[sidebar_content],
+                api_visibility="private",
+            )
+
+            # Update pipeline description and dropdown choices when language changes
+            def update_pipeline_on_lang_change(lang, current_pipeline):
+                # The choices need to stay as the internal keys, not translated
+                # Gradio-i18n will handle the display translation
+                description = get_pipeline_description(current_pipeline, lang)
+                return description
+
+            lang_selector.change(
+                fn=update_pipeline_on_lang_change,
+                inputs=[lang_selector, pipeline_dropdown],
+                outputs=[pipeline_description],
+                api_visibility="private",
+            )
+
+            with gr.Tabs(elem_classes="top-navbar") as navbar:
+                with gr.Tab(label=_("Transcribe")):
+                    submit.render()
+                with gr.Tab(label=_("Results"), id="result") as tab_visualizer:
+                    visualizer.render()
+
+        def sync_gradio_object_state(input_value, state_value):
+            """Synchronize the Collection."""
+            if input_value is not None:
+                return input_value
+            return gr.skip()
+
+        # Auto-navigate to Results tab after HTR processing, then sync collection
+        collection_submit_state.change(
+            lambda coll: gr.Tabs(selected="result") if coll else gr.skip(),
+            inputs=collection_submit_state,
+            outputs=navbar,
+            api_visibility="private",
+        ).then(
+            sync_gradio_object_state,
+            inputs=[collection_submit_state, collection_viz_state],
+            outputs=[collection_viz_state],
             api_visibility="private",
         )
 
-        # Update pipeline description and dropdown choices when language changes
-        def update_pipeline_on_lang_change(lang, current_pipeline):
-            # The choices need to stay as the internal keys, not translated
-            # Gradio-i18n will handle the display translation
-            description = get_pipeline_description(current_pipeline, lang)
-            return description
-
-        lang_selector.change(
-            fn=update_pipeline_on_lang_change,
-            inputs=[lang_selector, pipeline_dropdown],
-            outputs=[pipeline_description],
+        # Also sync when user manually navigates to Results tab
+        tab_visualizer.select(
+            inputs=[collection_submit_state, collection_viz_state],
+            outputs=[collection_viz_state],
+            fn=sync_gradio_object_state,
             api_visibility="private",
         )
 
-        with gr.Tabs(elem_classes="top-navbar") as navbar:
-            with gr.Tab(label=_("Transcribe")) as tab_submit:
-                submit.render()
-            with gr.Tab(label=_("Results"), id="result") as tab_visualizer:
-                visualizer.render()
-
-    def sync_gradio_object_state(input_value, state_value):
-        """Synchronize the Collection."""
-        if input_value is not None:
-            return input_value
-        return gr.skip()
-
-    # Auto-navigate to Results tab after HTR processing, then sync collection
-    collection_submit_state.change(
-        lambda coll: gr.Tabs(selected="result") if coll else gr.skip(),
-        inputs=collection_submit_state,
-        outputs=navbar,
-        api_visibility="private",
-    ).then(
-        sync_gradio_object_state,
-        inputs=[collection_submit_state, collection_viz_state],
-        outputs=[collection_viz_state],
-        api_visibility="private",
-    )
+        # Register MCP tools
+        # gr.api(htr_upload_image, api_name="htr_upload_image")
+        gr.api(
+            htr_transcribe,
+            api_name="htr_transcribe",
+            concurrency_limit=HTR_CONCURRENCY,
+        )
 
-    # Also sync when user manually navigates to Results tab
-    tab_visualizer.select(
-        inputs=[collection_submit_state, collection_viz_state],
-        outputs=[collection_viz_state],
-        fn=sync_gradio_object_state,
-        api_visibility="private",
-    )
+    # Hide the Translate component's auto-generated /on_lang_change API endpoint
+    for dep in demo.fns.values():
+        if hasattr(dep, "api_name") and dep.api_name == "on_lang_change":
+            dep.api_name = None
 
-    # Register MCP tools
-    # gr.api(htr_upload_image, api_name="htr_upload_image")
-    gr.api(htr_transcribe, api_name="htr_transcribe")
+    demo.queue()
+    return demo
 
-# Hide the Translate component's auto-generated /on_lang_change API endpoint
-for dep in demo.fns.values():
-    if hasattr(dep, "api_name") and dep.api_name == "on_lang_change":
-        dep.api_name = None
 
-demo.queue()
+# CPU worker processes (see app.parallel) are spawned, so they import this
+# module again as __mp_main__. They only run pipelines and must not build
+# the UI.
+if __name__ != "__mp_main__":
+    demo = build_demo()
 
 if __name__ == "__main__":
     # Add MCP export directory to allowed paths so files can be served
     mcp_export_dir = Path(__file__).parent / "mcp_exports"
     mcp_export_dir.mkdir(exist_ok=True)
 
+    # Load the template models in the background while the server starts
+    start_warmup()
+
     demo.launch(
         server_name="0.0.0.0",
         server_port=7860,
@@ -176,4 +207,7 @@ if __name__ == "__main__":
         root_path=os.environ.get("GRADIO_ROOT_PATH", ""),
         mcp_server=True,
         allowed_paths=[str(mcp_export_dir)],
+        # Health, metrics and visualizer page routes are registered before
+        # Gradio's own routes
+        app_kwargs={"routes": [*HEALTH_ROUTES, *METRICS_ROUTES, *VISUALIZER_ROUTES]},
     )
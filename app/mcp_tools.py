@@ -16,6 +16,8 @@ import uuid
 import gradio as gr
 from htrflow.volume.volume import Collection
 
+from app.iiif import display_url
+from app.metrics import EXPORT_DURATION, EXPORT_FILES
 from app.tabs.submit import run_htrflow, get_yaml
 from app.tabs.visualizer import rename_files_in_directory
 
@@ -111,12 +113,13 @@ def _run_htr_pipeline(
     if progress:
         progress(0, desc="Starting HTR transcription")
 
-    # run_htrflow is a generator that yields (collection, gr.skip())
-    result = next(
-        run_htrflow(
-            yaml_config, batch_images, progress=progress if progress else gr.Progress()
-        )
-    )
+    # run_htrflow is a generator that yields (collection, gr.skip()) for
+    # partial results; the last yield holds the complete collection
+    result = None
+    for result in run_htrflow(
+        yaml_config, batch_images, progress=progress if progress else gr.Progress()
+    ):
+        pass
     return result[0]  # Extract collection from tuple
 
 
@@ -169,7 +172,7 @@ def _resolve_page_image_url(page) -> str:
         return ""
     path_str = str(page_path)
     if path_str.startswith(("http://", "https://")):
-        return path_str
+        return display_url(path_str) or path_str
     if os.path.exists(path_str):
         return _build_file_url(path_str)
     return path_str
@@ -271,8 +274,10 @@ def _export_collection(
     export_base_dir.mkdir(exist_ok=True)
     export_dir = export_base_dir / output_format
 
-    collection.save(directory=str(export_dir), serializer=output_format)
-    exported_files = rename_files_in_directory(str(export_dir), output_format)
+    with EXPORT_DURATION.time(format=output_format):
+        collection.save(directory=str(export_dir), serializer=output_format)
+        exported_files = rename_files_in_directory(str(export_dir), output_format)
+    EXPORT_FILES.inc(len(exported_files), format=output_format)
 
     if len(exported_files) > 1:
         zip_path = export_base_dir / f"htrflow_export_{output_format}.zip"
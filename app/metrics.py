@@ -0,0 +1,218 @@
+"""
+Prometheus metrics for pipeline steps, ingestion and export.
+
+A small in-process registry of counters and histograms, rendered in the
+Prometheus text exposition format on the `/metrics` route.
+"""
+
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, math.inf)
+
+_REGISTRY = []
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{name}="{_escape(str(value))}"' for name, value in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        """The sample lines of the metric, in the text exposition format."""
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A monotonically increasing value."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Observations counted in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the enclosed block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        for key, counts in self._counts.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                bucket_labels = _format_labels(labels | {"le": _format_value(bound)})
+                samples.append(f"{self.name}_bucket{bucket_labels} {count}")
+            samples.append(
+                f"{self.name}_sum{_format_labels(labels)} {_format_value(self._sums[key])}"
+            )
+            samples.append(f"{self.name}_count{_format_labels(labels)} {counts[-1]}")
+        return samples
+
+
+STEP_DURATION = Histogram(
+    "htrflow_step_duration_seconds",
+    "Wall time of a pipeline step.",
+    ["step", "model"],
+)
+STEP_PAGES = Counter(
+    "htrflow_step_pages_total",
+    "Pages processed by a pipeline step.",
+    ["step", "model"],
+)
+STEP_SEGMENTS = Counter(
+    "htrflow_step_segments_total",
+    "Segments fed to a pipeline step (pages, regions or text lines, depending on the step).",
+    ["step", "model"],
+)
+STEP_THROUGHPUT = Histogram(
+    "htrflow_step_segments_per_second",
+    "Segments processed per second by a pipeline step (lines/second for text recognition).",
+    ["step", "model"],
+    buckets=THROUGHPUT_BUCKETS,
+)
+INGEST_DURATION = Histogram(
+    "htrflow_ingest_duration_seconds",
+    "Wall time of reading input images from a source.",
+    ["source"],
+)
+INGEST_IMAGES = Counter(
+    "htrflow_ingest_images_total",
+    "Images read from a source.",
+    ["source"],
+)
+EXPORT_DURATION = Histogram(
+    "htrflow_export_duration_seconds",
+    "Wall time of exporting a collection.",
+    ["format"],
+)
+EXPORT_FILES = Counter(
+    "htrflow_export_files_total",
+    "Files written by exports.",
+    ["format"],
+)
+
+
+def step_labels(step) -> dict[str, str]:
+    """Metric labels of a pipeline step: its class name and model, if any."""
+    model_kwargs = getattr(step, "model_kwargs", None) or {}
+    return {"step": str(step), "model": str(model_kwargs.get("model", ""))}
+
+
+def record_step(step, pages: int, segments: int, seconds: float):
+    """
+    Record a finished pipeline step.
+
+    Args:
+        step: The pipeline step
+        pages: Number of pages in the collection
+        segments: Number of segments the step ran on
+        seconds: Wall time of the step
+    """
+    labels = step_labels(step)
+    STEP_DURATION.observe(seconds, **labels)
+    STEP_PAGES.inc(pages, **labels)
+    STEP_SEGMENTS.inc(segments, **labels)
+    if seconds > 0:
+        STEP_THROUGHPUT.observe(segments / seconds, **labels)
+
+
+def render_metrics() -> str:
+    """Render all registered metrics in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+
+def metrics(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+METRICS_ROUTES = [Route("/metrics", metrics, methods=["GET"])]
@@ -0,0 +1,63 @@
+"""
+Parsing of page and canvas range selections such as "1-5, 8, 40-".
+"""
+
+import re
+
+_PART = re.compile(r"(\d*)\s*[-–]\s*(\d*)|(\d+)")
+
+
+def parse_ranges(selection: str | None) -> list[tuple[int, int | None]]:
+    """
+    Parse a range selection.
+
+    Numbers start at 1. "-3" selects 1-3 and "40-" selects everything from
+    40 on. Both hyphens and en dashes are accepted.
+
+    Args:
+        selection: The selection, e.g. "1-5, 8, 40-". Empty or None selects
+            everything.
+
+    Returns:
+        A list of (first, last) tuples, where last is None for open ranges
+
+    Raises:
+        ValueError: If the selection is malformed, selects number 0 or has a
+            range whose start is after its end
+    """
+    if not selection or not selection.strip():
+        return [(1, None)]
+
+    ranges = []
+    for part in selection.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = _PART.fullmatch(part)
+        if match is None:
+            raise ValueError(f"Invalid range: '{part}'")
+        if match.group(3):
+            first = last = int(match.group(3))
+        else:
+            first = int(match.group(1) or 1)
+            last = int(match.group(2)) if match.group(2) else None
+        if first < 1 or (last is not None and last < 1):
+            raise ValueError(f"Invalid range: '{part}' (numbers start at 1)")
+        if last is not None and first > last:
+            raise ValueError(f"Invalid range: '{part}' (start is after end)")
+        ranges.append((first, last))
+    return ranges
+
+
+def in_ranges(number: int, ranges: list[tuple[int, int | None]]) -> bool:
+    """Check if number (counted from 1) is selected by ranges."""
+    return any(
+        first <= number and (last is None or number <= last) for first, last in ranges
+    )
+
+
+def ranges_end(ranges: list[tuple[int, int | None]]) -> int | None:
+    """The last number selected by ranges, or None if a range is open."""
+    if any(last is None for _, last in ranges):
+        return None
+    return max((last for _, last in ranges), default=0)
@@ -0,0 +1,167 @@
+"""
+Page-level parallelism on CPU-only deployments.
+
+Without a GPU, a single job only keeps a few cores busy. Instead, the pages
+of a collection are distributed over a pool of worker processes. Each worker
+loads the pipeline steps into its own step cache once, runs with a pinned
+number of torch threads, and returns its processed page. The pages are
+merged back in their original order.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import torch
+from htrflow.volume.volume import Collection
+
+from app.autotune import run_step
+from app.collection_utils import dumps_collection, loads_collection, subset_collection
+from app.image_store import attach, job_image_store
+from app.step_cache import STEP_CACHE
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes used on machines without a GPU. 0 and 1
+# disable the process pool (a single worker would only add overhead); jobs
+# then run in the server process.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", 0))
+
+# Torch intra-op threads per worker process
+CPU_WORKER_THREADS = int(os.environ.get("CPU_WORKER_THREADS", 4))
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker(threads: int):
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forked workers would inherit the server's threads and torch state
+            _executor = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(CPU_WORKER_THREADS,),
+            )
+            logger.info(
+                "Started %d CPU worker processes with %d thread(s) each",
+                CPU_WORKERS,
+                CPU_WORKER_THREADS,
+            )
+    return _executor
+
+
+def use_process_pool(n_pages: int) -> bool:
+    """Check if a job with n_pages pages should be processed in worker processes."""
+    return CPU_WORKERS > 1 and n_pages > 1 and not torch.cuda.is_available()
+
+
+def _run_page(
+    config: dict, data: bytes, start: int, intermediate
+) -> tuple[bytes, list]:
+    """
+    Run steps start.. of a pipeline on a pickled single-page collection.
+
+    Runs in a worker process.
+
+    Returns:
+        The pickled processed collection, and the number of segments and
+        wall time of each step
+    """
+    steps = [
+        STEP_CACHE.get(step["step"], step.get("settings", {}))
+        for step in config["steps"]
+    ]
+    timings = []
+    with job_image_store():
+        collection = attach(loads_collection(data))
+        for step_index, step in enumerate(steps[start:], start=start + 1):
+            n_segments = len(collection.segments())
+            step_start = time.perf_counter()
+            collection = run_step(step, collection)
+            timings.append((n_segments, time.perf_counter() - step_start))
+            if intermediate is not None:
+                intermediate.save(collection, step_index)
+        return dumps_collection(collection), timings
+
+
+def run_in_process_pool(
+    config: dict,
+    collection: Collection,
+    start=0,
+    progress=None,
+    intermediate=None,
+    on_pages=None,
+) -> tuple[Collection, list[tuple[int, float]]]:
+    """
+    Run a pipeline with one task per page in the worker process pool.
+
+    Args:
+        config: Pipeline config (the parsed YAML)
+        collection: The collection to process
+        start: Index of the first step to run
+        progress: Optional Gradio progress tracker, updated per finished page
+        intermediate: Optional IntermediateResults; the workers store their
+            pages in the result cache after each step
+        on_pages: Optional callback that receives each page as soon as its
+            worker has finished it
+
+    Returns:
+        The processed collection with its pages in the original order, and
+        the total number of segments and the wall time of each step. The
+        steps run concurrently in the workers, so the wall time of the whole
+        run is split over the steps in proportion to their summed worker
+        times.
+    """
+    run_start = time.perf_counter()
+    executor = _get_executor()
+    n_pages = len(collection.pages)
+    futures = {
+        executor.submit(
+            _run_page,
+            config,
+            dumps_collection(subset_collection(collection, [page])),
+            start,
+            intermediate,
+        ): i
+        for i, page in enumerate(collection.pages)
+    }
+
+    pages = [None] * n_pages
+    totals = [(0, 0.0)] * (len(config["steps"]) - start)
+    for n_done, future in enumerate(as_completed(futures), start=1):
+        try:
+            data, timings = future.result()
+        except Exception:
+            for pending in futures:
+                pending.cancel()
+            raise
+        page = loads_collection(data).pages[0]
+        pages[futures[future]] = page
+        if on_pages:
+            on_pages([page])
+        totals = [
+            (segments + n, seconds + t)
+            for (segments, seconds), (n, t) in zip(totals, timings)
+        ]
+        if progress:
+            progress(n_done / n_pages, desc=f"Processed page {n_done} / {n_pages}")
+
+    elapsed = time.perf_counter() - run_start
+    worker_seconds = sum(seconds for _, seconds in totals)
+    timings = [
+        (segments, elapsed * seconds / worker_seconds if worker_seconds else 0.0)
+        for segments, seconds in totals
+    ]
+    return subset_collection(collection, pages), timings
@@ -0,0 +1,303 @@
+"""
+Streaming PDF rasterization.
+
+Pages are rendered one at a time at a target resolution, converted directly
+from the PyMuPDF pixmap to a numpy array and yielded as soon as they are
+ready, so a large PDF never has to be held in memory as a whole. Rendering
+can optionally be spread over worker processes. Pages that merely wrap a
+scanned image are not rendered at all: the embedded image is extracted at
+its native resolution.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Iterator
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+from app.page_ranges import in_ranges, parse_ranges
+from app.text_layer import extract_text_layer, save_text_layer
+
+logger = logging.getLogger(__name__)
+
+# Resolution of rendered PDF pages
+PDF_DPI = int(os.environ.get("PDF_DPI", 150))
+
+# Number of processes that render PDF pages in parallel. 0 renders in the
+# calling thread.
+PDF_RENDER_WORKERS = int(os.environ.get("PDF_RENDER_WORKERS", 0))
+
+# Size limit (in MB) of the directory of rendered PDF pages
+PDF_CACHE_MAX_MB = int(os.environ.get("PDF_CACHE_MAX_MB", 2048))
+
+
+def parse_page_range(page_range: str | None, n_pages: int) -> list[int]:
+    """
+    Parse a page range selection such as "1-5, 8, 10-".
+
+    Pages are numbered from 1 (see `app.page_ranges.parse_ranges`). Pages
+    outside the document are ignored.
+
+    Args:
+        page_range: The selection. Empty or None selects all pages.
+        n_pages: Number of pages in the document
+
+    Returns:
+        Zero-based page indices in document order, without duplicates
+
+    Raises:
+        ValueError: If the selection is malformed
+    """
+    ranges = parse_ranges(page_range)
+    return [i for i in range(n_pages) if in_ranges(i + 1, ranges)]
+
+
+def pixmap_to_array(pixmap: fitz.Pixmap) -> np.ndarray:
+    """Convert an RGB pixmap to a (height, width, 3) array without re-encoding."""
+    image = np.frombuffer(pixmap.samples, dtype=np.uint8)
+    # Rows may be padded beyond width * n bytes
+    image = image.reshape(pixmap.height, pixmap.stride)[:, : pixmap.width * pixmap.n]
+    return image.reshape(pixmap.height, pixmap.width, pixmap.n)
+
+
+def render_page(page: fitz.Page, dpi: int = PDF_DPI) -> np.ndarray:
+    """Render a PDF page to an RGB array at dpi."""
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    return pixmap_to_array(pixmap)
+
+
+# Embedded image formats that are written to disk as they are
+_EXTRACTABLE_FORMATS = {"jpeg": "jpg", "png": "png"}
+
+# Share of the page a single image must cover for the page to count as a scan
+_MIN_SCAN_COVERAGE = 0.9
+
+
+def embedded_scan(document: fitz.Document, page: fitz.Page) -> dict | None:
+    """
+    Get the embedded image of a page that is a wrapper around a single scan.
+
+    A page counts as a scan if it shows exactly one upright image that
+    covers (almost) the whole page, without transparency. Invisible text
+    layers are allowed. Pages with drawings or several images are composite
+    and must be rendered.
+
+    Returns:
+        The image as returned by `fitz.Document.extract_image` (with the
+        encoded image under "image" and its format under "ext") plus its
+        position on the page under "bbox", or None
+        if the page is not a single-image scan or its format cannot be
+        written as is
+    """
+    if page.rotation:
+        return None
+    infos = page.get_image_info(xrefs=True)
+    if len(infos) != 1 or not infos[0]["xref"]:
+        return None
+
+    info = infos[0]
+    a, b, c, d, _, _ = info["transform"]
+    if b or c or a <= 0 or d <= 0:
+        return None
+    coverage = abs(fitz.Rect(info["bbox"]) & page.rect) / abs(page.rect)
+    if coverage < _MIN_SCAN_COVERAGE or page.get_drawings():
+        return None
+
+    image = document.extract_image(info["xref"])
+    if not image or image.get("smask") or image["ext"] not in _EXTRACTABLE_FORMATS:
+        return None
+    image["bbox"] = fitz.Rect(info["bbox"])
+    return image
+
+
+def _output_path(output_dir: str, page_index: int, ext: str = "png") -> str:
+    return os.path.join(output_dir, f"page_{page_index + 1:04d}.{ext}")
+
+
+def _existing_output(output_dir: str, page_index: int) -> str | None:
+    for ext in _EXTRACTABLE_FORMATS.values():
+        path = _output_path(output_dir, page_index, ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _write_atomic(path: str, write) -> str:
+    # Write atomically, since another job may be reading the same pages
+    base, ext = os.path.splitext(path)
+    tmp_path = f"{base}.{os.getpid()}.tmp{ext}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _write_page(image: np.ndarray, path: str) -> str:
+    # Rendered pages are written losslessly, so the pipeline sees the same
+    # pixels as the renderer. A low compression level keeps encoding cheap.
+    return _write_atomic(
+        path,
+        lambda tmp_path: cv2.imwrite(
+            tmp_path,
+            cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+            [cv2.IMWRITE_PNG_COMPRESSION, 1],
+        ),
+    )
+
+
+def _write_bytes(data: bytes, path: str) -> str:
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+    return _write_atomic(path, write)
+
+
+def export_page(
+    document: fitz.Document, page_index: int, dpi: int, output_dir: str
+) -> str:
+    """
+    Write a PDF page to an image file in output_dir.
+
+    Single-image scan pages are extracted at their native resolution
+    without rasterizing; other pages are rendered at dpi. If the page has a
+    usable text layer, it is registered for the image (see app.text_layer).
+
+    Returns:
+        Path to the image file
+    """
+    page = document[page_index]
+    scan = embedded_scan(document, page)
+    if scan is not None:
+        ext = _EXTRACTABLE_FORMATS[scan["ext"]]
+        path = _write_bytes(scan["image"], _output_path(output_dir, page_index, ext))
+        bbox = scan["bbox"]
+        transform = fitz.Matrix(1, 0, 0, 1, -bbox.x0, -bbox.y0) * fitz.Matrix(
+            scan["width"] / bbox.width, scan["height"] / bbox.height
+        )
+    else:
+        path = _write_page(render_page(page, dpi), _output_path(output_dir, page_index))
+        transform = fitz.Matrix(dpi / 72, dpi / 72)
+
+    blocks = extract_text_layer(page, transform)
+    if blocks:
+        save_text_layer(path, blocks)
+    return path
+
+
+def _export_page_in_worker(
+    pdf_path: str, page_index: int, dpi: int, output_dir: str
+) -> str:
+    """Write one page to an image file. Runs in a render worker process."""
+    with fitz.open(pdf_path) as document:
+        return export_page(document, page_index, dpi, output_dir)
+
+
+def pdf_output_dir(pdf_path: str, dpi: int, root: str) -> str:
+    """Directory for the rendered pages of a PDF, unique per file content and DPI."""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return os.path.join(root, f"{digest.hexdigest()[:16]}_{dpi}dpi")
+
+
+def _directory_size(directory: str) -> int:
+    size = 0
+    for dir_path, _dirs, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, file))
+            except FileNotFoundError:
+                continue
+    return size
+
+
+def evict(
+    root: str, keep: set[str] = frozenset(), max_bytes: int = PDF_CACHE_MAX_MB * 1024**2
+):
+    """
+    Remove the least recently used rendered PDFs until root fits max_bytes.
+
+    Each output directory (see `pdf_output_dir`) is removed as a whole.
+    Directories are marked as used when they are rendered to.
+    """
+    directories = []
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        directories.append((entry.path, mtime, _directory_size(entry.path)))
+
+    total_bytes = sum(size for _, _, size in directories)
+    for path, _, size in sorted(directories, key=lambda directory: directory[1]):
+        if total_bytes <= max_bytes:
+            break
+        if path in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
+
+
+def render_pdf_to_files(
+    pdf_path: str,
+    output_dir: str,
+    dpi: int = PDF_DPI,
+    page_range: str | None = None,
+    workers: int = PDF_RENDER_WORKERS,
+) -> Iterator[str]:
+    """
+    Write the pages of a PDF to image files, in page order.
+
+    Pages that are a single scanned image are extracted as they are (see
+    `embedded_scan`); other pages are rendered to PNG files. Pages that
+    were already written to output_dir are not processed again.
+
+    Args:
+        pdf_path: Path to the PDF file
+        output_dir: Directory of the rendered pages
+        dpi: Target resolution
+        page_range: Optional page selection (see `parse_page_range`)
+        workers: Number of render processes (0 renders in this thread)
+
+    Yields:
+        The path of each rendered page, as soon as it is written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Mark as recently used (see `evict`)
+    os.utime(output_dir)
+    with fitz.open(pdf_path) as document:
+        page_indices = parse_page_range(page_range, len(document))
+
+        if workers <= 1:
+            for page_index in page_indices:
+                path = _existing_output(output_dir, page_index)
+                yield path or export_page(document, page_index, dpi, output_dir)
+            return
+
+    with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as executor:
+        futures = []
+        for page_index in page_indices:
+            path = _existing_output(output_dir, page_index)
+            if path:
+                futures.append(path)
+            else:
+                futures.append(
+                    executor.submit(
+                        _export_page_in_worker, pdf_path, page_index, dpi, output_dir
+                    )
+                )
+        for future in futures:
+            yield future if isinstance(future, str) else future.result()
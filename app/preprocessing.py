@@ -0,0 +1,130 @@
+"""
+Resolution cap for the images fed to inference steps.
+
+Full-resolution scans (for example IIIF `full/max` images) are often more
+than 6000 px on the long side, which segmentation does not need. Images
+that exceed the cap are downscaled before inference, and the segments in
+the results are scaled back, so that all coordinates stored in the
+collection refer to the original image.
+
+The cap is set per step with `generation_settings.max_side`, or for the
+segmentation of whole pages with MAX_IMAGE_SIDE.
+"""
+
+import os
+
+import cv2
+import numpy as np
+from htrflow.pipeline.steps import STEPS, ImportSegmentation, Inference, Segmentation
+from htrflow.results import Result
+from htrflow.volume.volume import ImageNode, PageNode
+
+# Maximum long side (in pixels) of the page images fed to the first
+# segmentation step. 0 disables the cap.
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", 0))
+
+
+def pop_max_side(step, generation_kwargs: dict, nodes: list[ImageNode]) -> int:
+    """
+    Get the resolution cap of a step run.
+
+    Removes `max_side` from generation_kwargs, since it is not a model
+    argument.
+
+    Returns:
+        The maximum long side of the input images, or 0 for no cap
+    """
+    max_side = generation_kwargs.pop("max_side", None)
+    if max_side is not None:
+        return int(max_side)
+    if isinstance(step, Segmentation) and all(
+        isinstance(node, PageNode) for node in nodes
+    ):
+        return MAX_IMAGE_SIDE
+    return 0
+
+
+def page_side(config: dict) -> int:
+    """
+    Get the resolution cap of the page images of a pipeline.
+
+    Only pipelines with a single inference step run their models on the
+    page images alone. In all other pipelines, the later steps crop their
+    input (regions, text lines) from the page image at its full resolution.
+
+    Args:
+        config: Pipeline config (the parsed YAML)
+
+    Returns:
+        The maximum long side the page images are used at, or 0 if the
+        pipeline needs them at full resolution
+    """
+    inference_steps = []
+    for step in config["steps"]:
+        step_class = STEPS.get(step["step"].lower())
+        if step_class is None:
+            continue
+        if issubclass(step_class, ImportSegmentation):
+            return 0
+        if issubclass(step_class, Inference):
+            inference_steps.append((step_class, step.get("settings", {})))
+
+    if len(inference_steps) != 1:
+        return 0
+    step_class, settings = inference_steps[0]
+    max_side = settings.get("generation_settings", {}).get("max_side")
+    if max_side is not None:
+        return int(max_side)
+    if issubclass(step_class, Segmentation):
+        return MAX_IMAGE_SIDE
+    return 0
+
+
+def scale_factor(width: int, height: int, max_side: int) -> float:
+    """Factor that scales a width x height image down to max_side (at most 1)."""
+    if not max_side or max(width, height) <= max_side:
+        return 1.0
+    return max_side / max(width, height)
+
+
+def downscale(image: np.ndarray, max_side: int) -> tuple[np.ndarray, float]:
+    """
+    Downscale an image so that its long side is at most max_side.
+
+    Returns:
+        The (possibly) downscaled image and the applied scale factor
+    """
+    height, width = image.shape[:2]
+    factor = scale_factor(width, height, max_side)
+    if factor == 1.0:
+        return image, factor
+    size = (max(round(width * factor), 1), max(round(height * factor), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), factor
+
+
+def predict_capped(
+    model, nodes: list[ImageNode], max_side: int, **kwargs
+) -> list[Result]:
+    """
+    Run a model on the images of nodes with a resolution cap.
+
+    The results are rescaled to the original image coordinates.
+
+    Args:
+        model: An htrflow model
+        nodes: The nodes to run the model on
+        max_side: Maximum long side of the input images (0 for no cap)
+        **kwargs: Forwarded to the model, e.g. `batch_size`
+
+    Returns:
+        One result per node
+    """
+    if not max_side:
+        return model([node.image for node in nodes], **kwargs)
+
+    images, factors = zip(*(downscale(node.image, max_side) for node in nodes))
+    results = model(list(images), **kwargs)
+    for result, factor in zip(results, factors):
+        if factor != 1.0:
+            result.rescale(1 / factor)
+    return results
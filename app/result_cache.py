@@ -0,0 +1,339 @@
+"""
+Content-addressed cache of transcription results.
+
+Processed pages are stored under a hash of the image file, the normalized
+pipeline config and the process-wide settings that change its results
+(MAX_IMAGE_SIDE and CPU_BACKEND), so an image that has already been transcribed
+with the same pipeline is returned without running the models. Pages are
+also stored after every intermediate step (see `IntermediateResults`), so a
+job whose first steps match an earlier job on the same image starts from
+the cached segmentation. The storage backend is pluggable (see
+`ResultStore`); by default results are kept in a local directory.
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+
+from htrflow.volume.volume import Collection, PageNode
+
+from app.collection_utils import (
+    dumps_collection,
+    loads_collection,
+    rebind_page,
+    subset_collection,
+)
+from app.backends import CPU_BACKEND
+from app.fetch import local_source
+from app.preprocessing import MAX_IMAGE_SIDE
+from app.step_cache import config_hash
+
+logger = logging.getLogger(__name__)
+
+# Directory of the default result store. Set to an empty string to disable
+# result caching.
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", ".htrflow_cache/results")
+
+# Size limit (in MB) of the default result store
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 2048))
+
+
+class ResultStore(ABC):
+    """Key-value storage backend of the result cache."""
+
+    @abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """Get the value stored under key, or None if there is none."""
+
+    @abstractmethod
+    def put(self, key: str, value: bytes) -> None:
+        """Store value under key."""
+
+
+class LocalDirectoryStore(ResultStore):
+    """
+    Store values as files in a local directory.
+
+    The least recently used files are removed once the directory exceeds
+    `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int | None = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._files())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _files(self):
+        for root, _dirs, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+
+        with self._lock:
+            if os.path.exists(path):
+                self._total_bytes -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._total_bytes += len(value)
+            self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None or self._total_bytes <= self.max_bytes:
+            return
+        for path, _, size in sorted(self._files(), key=lambda file: file[1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._total_bytes -= size
+
+
+_store: ResultStore | None = (
+    LocalDirectoryStore(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024**2)
+    if RESULT_CACHE_DIR
+    else None
+)
+
+
+def set_result_store(store: ResultStore | None):
+    """Replace the storage backend of the result cache (None disables it)."""
+    global _store
+    _store = store
+
+
+def get_result_store() -> ResultStore | None:
+    return _store
+
+
+def image_digest(path: str) -> str:
+    """
+    Hash the content of an image file.
+
+    The digest is independent of the file name and of where the image was
+    downloaded from. The file is hashed rather than its decoded pixels, so
+    that looking up a job's pages does not decode them all up front. Digests
+    are memoized per local file, modification time and size, so a remote
+    image whose download was replaced by newer content (see app.fetch) is
+    hashed again.
+    """
+    source = local_source(path)
+    stat = os.stat(source)
+    return _file_digest(source, stat.st_mtime, stat.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_digest(source: str, mtime: float, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Settings outside the pipeline config that change the results of its steps
+_SETTINGS = {"max_image_side": MAX_IMAGE_SIDE, "cpu_backend": CPU_BACKEND}
+
+
+def page_key(digest: str, steps: list[dict]) -> str:
+    """
+    Cache key of a page: its image digest, the pipeline steps run on it and
+    the process-wide settings they ran with.
+    """
+    return config_hash({"image": digest, "steps": steps, "settings": _SETTINGS})
+
+
+def get_page(digest: str, steps: list[dict], path: str) -> PageNode | None:
+    """
+    Get a cached page and point it at the image at `path`.
+
+    Returns:
+        The cached page, or None on a cache miss
+    """
+    if _store is None:
+        return None
+    try:
+        value = _store.get(page_key(digest, steps))
+        if value is None:
+            return None
+        page = loads_collection(value).pages[0]
+    except Exception:
+        logger.exception("Could not read cached result for image %s", path)
+        return None
+    return rebind_page(page, path)
+
+
+def put_page(digest: str, steps: list[dict], collection: Collection, page: PageNode):
+    """Store a processed page of `collection`."""
+    if _store is None:
+        return
+    try:
+        value = dumps_collection(subset_collection(collection, [page]))
+        _store.put(page_key(digest, steps), value)
+    except Exception:
+        logger.exception("Could not cache result for image %s", page.path)
+
+
+def run_with_result_cache(
+    config: dict, images: list[str], run, progress=None, on_pages=None
+) -> Collection:
+    """
+    Run a pipeline, skipping images that have already been processed.
+
+    Args:
+        config: Pipeline config (the parsed YAML)
+        images: Paths or URLs of the images to process
+        run: Function that processes the remaining images, called as
+            `run(config, images, progress=progress, on_pages=on_pages)`
+        progress: Optional Gradio progress tracker
+        on_pages: Optional callback that receives finished pages before the
+            whole job is done. Cached pages are passed to it right away.
+
+    Returns:
+        A collection with one page per readable input image, in the page
+        order a fresh run would produce
+    """
+    if _store is None:
+        return run(config, images, progress=progress, on_pages=on_pages)
+
+    steps = config["steps"]
+    cached_pages = []
+    missing = []
+    for image in images:
+        try:
+            digest = image_digest(image)
+        except Exception:
+            # Unreadable images are left for the pipeline to report
+            missing.append(image)
+            continue
+        page = get_page(digest, steps, image)
+        if page is None:
+            missing.append(image)
+        else:
+            cached_pages.append(page)
+
+    logger.info(
+        "Result cache: %d of %d image(s) already processed",
+        len(cached_pages),
+        len(images),
+    )
+
+    if cached_pages and on_pages:
+        on_pages(cached_pages)
+
+    # The pipeline stores the pages it processes (see IntermediateResults)
+    if missing:
+        collection = run(config, missing, progress=progress, on_pages=on_pages)
+    else:
+        collection = Collection([], label="demo_output")
+
+    pages = sorted(cached_pages + collection.pages, key=lambda page: page.path)
+    return subset_collection(collection, pages)
+
+
+class IntermediateResults:
+    """
+    Per-step snapshots of the pages of a job.
+
+    After step k, each page is stored under its image digest and the
+    config of steps 1..k. A later job on the same image whose first k
+    steps are identical (for example one that only changes the text
+    recognition model) restores the pages from the snapshot and skips
+    those steps. The snapshot after the last step is the full result
+    used by `run_with_result_cache`.
+    """
+
+    def __init__(self, steps: list[dict]):
+        """
+        Args:
+            steps: The `steps` list of the pipeline config
+        """
+        self.steps = steps
+
+    @staticmethod
+    def _source(page: PageNode) -> str:
+        # Image processing steps may change page.path, but the original
+        # input path is kept in the page data
+        return page.get("image_path", page.path)
+
+    def restore(self, images: list[str], label: str) -> tuple[Collection, int] | None:
+        """
+        Restore the pages of a job from the longest cached step prefix.
+
+        Args:
+            images: Paths or URLs of the input images
+            label: Label of the restored collection
+
+        Returns:
+            A (collection, completed_steps) tuple, or None if no prefix of
+            the pipeline is cached for all images
+        """
+        if _store is None or not images:
+            return None
+
+        try:
+            digests = [image_digest(image) for image in images]
+        except Exception:
+            return None
+
+        for completed_steps in range(len(self.steps), 0, -1):
+            prefix = self.steps[:completed_steps]
+            pages = []
+            for image, digest in zip(images, digests):
+                page = get_page(digest, prefix, image)
+                if page is None:
+                    break
+                pages.append(page)
+            else:
+                logger.info(
+                    "Restored %d page(s) after step %d / %d from cache",
+                    len(pages),
+                    completed_steps,
+                    len(self.steps),
+                )
+                collection = Collection([], label=label)
+                collection.pages = sorted(pages, key=lambda page: page.path)
+                return collection, completed_steps
+        return None
+
+    def save(self, collection: Collection, completed_steps: int):
+        """Store the pages of `collection` after `completed_steps` steps."""
+        if _store is None:
+            return
+        prefix = self.steps[:completed_steps]
+        for page in collection.pages:
+            try:
+                digest = image_digest(self._source(page))
+            except Exception:
+                continue
+            put_page(digest, prefix, collection, page)
@@ -0,0 +1,176 @@
+"""
+Process-wide cache of initialized HTRflow pipeline steps.
+
+Loading the YOLO and TrOCR weights often takes longer than running inference
+on a handful of images, so steps are initialized once and shared by all jobs
+whose model configuration is identical. A step's `generation_settings` (such
+as its batch size) are not part of the model, so steps that only differ in
+them share one loaded model and get their generation settings per call.
+Entries are evicted in least recently used order once the cached models
+exceed the configured memory budget.
+"""
+
+import copy
+import gc
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from itertools import chain
+
+import torch
+from htrflow.pipeline.steps import Inference, PipelineStep, init_step
+
+from app.backends import apply_backend, artifact_size, pop_backend
+
+logger = logging.getLogger(__name__)
+
+# Memory budget (in MB) for the models held by cached steps
+STEP_CACHE_MAX_MB = int(os.environ.get("STEP_CACHE_MAX_MB", 8192))
+
+
+def config_hash(config) -> str:
+    """
+    Return a stable hash of a YAML-loaded configuration object.
+
+    The configuration is serialized with sorted keys so that key order and
+    YAML formatting do not affect the result.
+    """
+    normalized = json.dumps(config, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def step_size(step: PipelineStep) -> int:
+    """
+    Estimate the memory held by a step's model, in bytes.
+
+    Counts the parameters and buffers of the underlying torch module, or
+    the size of the converted model for steps on another backend (see
+    `app.backends.artifact_size`). Steps without a model (e.g. `OrderLines`)
+    are considered free.
+    """
+    model = getattr(step, "model", None)
+    size = artifact_size(model)
+    if size is not None:
+        return size
+    module = getattr(model, "model", None)
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    tensors = chain(module.parameters(), module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def _load_model(step: PipelineStep):
+    """Load the model of an `Inference` step now instead of on its first run."""
+    init_model = getattr(step, "_init_model", None)
+    if init_model is not None and getattr(step, "model", None) is None:
+        init_model()
+
+
+class StepCache:
+    """LRU cache of initialized pipeline steps with a memory budget."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._steps: OrderedDict[str, tuple[PipelineStep, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    @staticmethod
+    def key(step_name: str, settings: dict) -> str:
+        """
+        Cache key of a step, derived from its normalized YAML config.
+
+        The step's `generation_settings` are left out, since they do not
+        change the loaded model.
+        """
+        model_settings = {
+            name: value
+            for name, value in settings.items()
+            if name != "generation_settings"
+        }
+        return config_hash({"step": step_name.lower(), "settings": model_settings})
+
+    def get(self, step_name: str, settings: dict) -> PipelineStep:
+        """
+        Get an initialized step, loading its model on a cache miss.
+
+        Args:
+            step_name: Name of the pipeline step (e.g. "Segmentation")
+            settings: The step's `settings` mapping from the YAML config
+
+        Returns:
+            A copy of the cached step that shares its model and runs with
+            the `generation_settings` of `settings`. The copy's `cache_key`
+            attribute holds the key of the cached step.
+        """
+        key = self.key(step_name, settings)
+        step = copy.copy(self._get(key, step_name, settings))
+        step.cache_key = key
+        if isinstance(step, Inference):
+            step.generation_kwargs = copy.deepcopy(
+                settings.get("generation_settings", {})
+            )
+        return step
+
+    def _get(self, key: str, step_name: str, settings: dict) -> PipelineStep:
+        """Get the cached step under key, initializing it on a miss."""
+        with self._lock:
+            init_lock = self._init_locks[key]
+
+        # Concurrent requests for the same step wait for a single load
+        # instead of loading the same weights twice
+        with init_lock:
+            with self._lock:
+                if key in self._steps:
+                    self._steps.move_to_end(key)
+                    return self._steps[key][0]
+
+            # The backend is not an htrflow setting. init_step pops keys
+            # from the settings, so pass a copy.
+            step_settings, backend = pop_backend(settings)
+            step_settings.pop("generation_settings", None)
+            step = init_step(step_name, copy.deepcopy(step_settings))
+            _load_model(step)
+            apply_backend(step, backend)
+            size = step_size(step)
+            logger.info("Step cache miss: loaded %s (%.1f MB)", step, size / 1024**2)
+
+            with self._lock:
+                self._steps[key] = (step, size)
+                self._evict()
+        return step
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._steps
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for _, size in self._steps.values())
+
+    def _evict(self):
+        """Drop least recently used steps until the cache fits the budget."""
+        evicted = False
+        # The most recently used entry is never evicted, even if it alone
+        # exceeds the budget
+        while len(self._steps) > 1 and self.total_bytes > self.max_bytes:
+            key, (step, size) = self._steps.popitem(last=False)
+            self._init_locks.pop(key, None)
+            logger.info("Step cache: evicted %s (%.1f MB)", step, size / 1024**2)
+            evicted = True
+
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            self._steps.clear()
+            self._init_locks.clear()
+
+
+STEP_CACHE = StepCache(STEP_CACHE_MAX_MB * 1024**2)
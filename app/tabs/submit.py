@@ -1,22 +1,54 @@
-import io
+import contextvars
+import fcntl
+import glob
 import logging
 import os
-import re
+import queue
+import shutil
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import certifi
-import fitz  # PyMuPDF
 import gradio as gr
 import pycurl
 import yaml
 import spaces
 
 from htrflow.pipeline.pipeline import Pipeline
-from htrflow.pipeline.steps import init_step
+from htrflow.pipeline.steps import Segmentation
 from htrflow.volume.volume import Collection
-from PIL import Image
 
+from app.autotune import run_step
+from app.batching import MicroBatcher
+from app.collection_utils import load_collection, save_collection, subset_collection
+from app.fetch import is_remote, prefetch
+from app.iiif import (
+    IIIF_THUMBNAIL_SIDE,
+    canvas_image,
+    canvas_label,
+    fetch_manifest_canvases,
+    iiif_image_url,
+    inference_side,
+    sized_image_url,
+    sized_image_urls,
+)
+from app.image_store import attach, job_image_store, new_collection, release_images
+from app.metrics import INGEST_DURATION, INGEST_IMAGES, record_step
+from app.parallel import run_in_process_pool, use_process_pool
+from app.pdf import PDF_DPI, evict as evict_pdfs, pdf_output_dir, render_pdf_to_files
 from app.pipelines import PIPELINES
+from app.result_cache import IntermediateResults, run_with_result_cache
+from app.step_cache import STEP_CACHE, config_hash
+from app.text_layer import run_with_text_layers
+from app.thumbnails import full_image, thumbnail
+from app.validation import (
+    DOWNSAMPLED,
+    DUPLICATE,
+    TOO_LARGE,
+    UNREADABLE,
+    validate_uploads,
+)
 from gradio_i18n import gettext as _
 
 logger = logging.getLogger(__name__)
@@ -24,6 +56,33 @@ logger = logging.getLogger(__name__)
 # Max number of images a user can upload at once
 MAX_IMAGES = int(os.environ.get("MAX_IMAGES", 5))
 
+# Number of HTR jobs that may run at the same time. Raise this together with
+# BATCH_WINDOW_MS to let concurrent jobs be batched into one pipeline run.
+HTR_CONCURRENCY = int(os.environ.get("HTR_CONCURRENCY", 1))
+
+# Number of pages per group in which the steps after the last segmentation
+# step are run, so that finished pages are shown in the Results tab while the
+# rest of the job is still running. The segmentation steps still run on all
+# pages of a job (or chunk) at once.
+STREAM_GROUP_PAGES = int(os.environ.get("STREAM_GROUP_PAGES", 1))
+
+# Jobs with more pages than this are run in chunks of this many pages. Each
+# chunk is processed, spooled to disk and released before the next one is
+# loaded, so peak memory depends on the chunk size rather than the document
+# length. Set to 0 to run every job as a single collection.
+PIPELINE_CHUNK_PAGES = int(os.environ.get("PIPELINE_CHUNK_PAGES", 16))
+
+# Directory for per-step checkpoints of running jobs. A job that fails or is
+# preempted is resumed from its last completed step when it is resubmitted.
+# Set to an empty string to disable checkpointing.
+CHECKPOINT_DIR = os.environ.get(
+    "CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "htrflow_checkpoints")
+)
+
+# Size limit (in MB) of the checkpoints of abandoned jobs. The least recently
+# written checkpoints that no running job holds are removed first.
+CHECKPOINT_MAX_MB = int(os.environ.get("CHECKPOINT_MAX_MB", 4096))
+
 # Setup the cache directory to point to the directory where the example images
 # are located. The images must lay in the cache directory because otherwise they
 # have to be reuploaded when drag-and-dropped to the input image widget.
@@ -35,29 +94,79 @@ if os.environ.get("GRADIO_CACHE_DIR", GRADIO_CACHE) != GRADIO_CACHE:
     logger.warning("Setting GRADIO_CACHE_DIR to '%s' (overriding a previous value).")
 
 
+def _scaled_progress(progress, start: float, end: float):
+    """Map the 0-1 progress of a sub-task onto the range start-end of progress."""
+
+    def update(fraction, desc=None):
+        progress(start + fraction * (end - start), desc=desc)
+
+    return update
+
+
 class PipelineWithProgress(Pipeline):
     @classmethod
     def from_config(cls, config: dict[str, str]):
-        """Init pipeline from config, ensuring the correct subclass is instantiated."""
-        return cls(
+        """
+        Init pipeline from config, ensuring the correct subclass is instantiated.
+
+        Steps are taken from the process-wide step cache, so models that were
+        loaded by an earlier job with the same step config are reused.
+        """
+        pipe = cls(
             [
-                init_step(step["step"], step.get("settings", {}))
+                STEP_CACHE.get(step["step"], step.get("settings", {}))
                 for step in config["steps"]
             ]
         )
-
-    def run(self, collection, start=0, progress=None):
+        # Worker processes build their own pipeline from the config
+        pipe.config = config
+        return pipe
+
+    def run(
+        self,
+        collection,
+        start=0,
+        progress=None,
+        checkpoint_dir=None,
+        intermediate=None,
+        on_pages=None,
+    ):
         """
         Run pipeline on collection with Gradio progress support.
         If progress is provided, it updates the Gradio progress bar during execution.
+        If checkpoint_dir is provided, the collection is saved there after each
+        step so that the job can be resumed with `resume()`.
+        If intermediate (an IntermediateResults instance) is provided, the pages
+        are stored in the result cache after each step.
+        On machines without a GPU, the pages are processed in parallel by the
+        CPU worker pool if it is enabled (see app.parallel). Such runs are not
+        checkpointed.
+        If on_pages is provided, every page is passed to it once it is done.
+        The steps after the last segmentation step are then run on groups of
+        STREAM_GROUP_PAGES pages (see `_run_streamed`), and are not
+        checkpointed.
         """
-        total_steps = len(self.steps[start:])
-        for i, step in enumerate(self.steps[start:]):
-            step_name = f"{step} (step {start + i + 1} / {total_steps})"
+        total_steps = len(self.steps)
+        if start < total_steps and use_process_pool(len(collection.pages)):
+            return self._run_in_process_pool(
+                collection, start, progress, intermediate, on_pages
+            )
+
+        stream_start = total_steps
+        if on_pages and len(collection.pages) > max(STREAM_GROUP_PAGES, 1):
+            stream_start = max(start, self._stream_start())
+
+        for i, step in enumerate(self.steps[start:stream_start]):
+            step_index = start + i + 1
+            step_name = f"{step} (step {step_index} / {total_steps})"
 
             try:
-                progress((i + 1) / total_steps, desc=f"Running {step_name}")
-                collection = step.run(collection)
+                if progress:
+                    progress(step_index / total_steps, desc=f"Running {step_name}")
+                n_segments = len(collection.segments())
+                step_start = time.perf_counter()
+                collection = run_step(step, collection)
+                elapsed = time.perf_counter() - step_start
 
             except Exception:
                 if self.pickle_path:
@@ -69,32 +178,466 @@ class PipelineWithProgress(Pipeline):
                         f"HTRflow: Pipeline failed on step {step_name}",
                     )
                 raise
+
+            record_step(step, len(collection.pages), n_segments, elapsed)
+            logger.info(
+                "Step %s finished in %.2fs (%d page(s), %d segment(s))",
+                step_name,
+                elapsed,
+                len(collection.pages),
+                n_segments,
+            )
+
+            if intermediate is not None:
+                intermediate.save(collection, step_index)
+
+            # No checkpoint is needed once the last step has finished
+            if checkpoint_dir and step_index < total_steps:
+                self.pickle_path = save_checkpoint(
+                    collection, checkpoint_dir, step_index
+                )
+
+        if stream_start < total_steps:
+            return self._run_streamed(
+                collection, stream_start, progress, intermediate, on_pages
+            )
+        if on_pages:
+            on_pages(collection.pages)
         return collection
 
+    def _stream_start(self) -> int:
+        """Index of the first step after the last segmentation step."""
+        segmentation = [
+            i for i, step in enumerate(self.steps) if isinstance(step, Segmentation)
+        ]
+        return segmentation[-1] + 1 if segmentation else 0
+
+    def _run_streamed(self, collection, start, progress, intermediate, on_pages):
+        """
+        Run steps start.. on groups of STREAM_GROUP_PAGES pages.
+
+        Each group is passed to on_pages as soon as its last step is done.
+        The segments of a group (for example the text lines of its pages)
+        are still batched together by each step.
+        """
+        total_steps = len(self.steps)
+        size = max(STREAM_GROUP_PAGES, 1)
+        pages = collection.pages
+        groups = [pages[i : i + size] for i in range(0, len(pages), size)]
+        totals = [(0, 0.0)] * (total_steps - start)
+        done = []
+        for n_group, group in enumerate(groups):
+            group_collection = subset_collection(collection, group)
+            for i, step in enumerate(self.steps[start:]):
+                step_index = start + i + 1
+                step_name = f"{step} (step {step_index} / {total_steps})"
+                if progress:
+                    progress(
+                        (start + (n_group * (total_steps - start) + i) / len(groups))
+                        / total_steps,
+                        desc=f"Running {step_name} on page {len(done) + 1} / {len(pages)}",
+                    )
+                try:
+                    n_segments = len(group_collection.segments())
+                    step_start = time.perf_counter()
+                    group_collection = run_step(step, group_collection)
+                    elapsed = time.perf_counter() - step_start
+                except Exception:
+                    gr.Error(f"HTRflow: Pipeline failed on step {step_name}")
+                    raise
+                segments, seconds = totals[i]
+                totals[i] = (segments + n_segments, seconds + elapsed)
+                if intermediate is not None:
+                    intermediate.save(group_collection, step_index)
+
+            done.extend(group_collection.pages)
+            on_pages(group_collection.pages)
+
+        for step, (n_segments, elapsed) in zip(self.steps[start:], totals):
+            record_step(step, len(done), n_segments, elapsed)
+        return subset_collection(collection, done)
+
+    def _run_in_process_pool(
+        self, collection, start, progress, intermediate, on_pages=None
+    ):
+        n_pages = len(collection.pages)
+        logger.info("Running %d page(s) in the CPU worker pool", n_pages)
+        try:
+            collection, timings = run_in_process_pool(
+                self.config,
+                collection,
+                start=start,
+                progress=progress,
+                intermediate=intermediate,
+                on_pages=on_pages,
+            )
+        except Exception:
+            gr.Error("HTRflow: Pipeline failed in a CPU worker process")
+            raise
+
+        for step, (n_segments, elapsed) in zip(self.steps[start:], timings):
+            record_step(step, n_pages, n_segments, elapsed)
+        return collection
+
+    def run_chunked(self, images, chunk_size, run_chunk, progress=None, on_pages=None):
+        """
+        Run the pipeline over fixed-size chunks of pages.
+
+        Each chunk is processed with run_chunk, its cached images are released
+        and the result is spooled to disk before the next chunk is loaded. The
+        spooled chunks are merged into one collection at the end, without
+        page images.
+
+        Args:
+            images: Paths of the input images, in page order
+            chunk_size: Number of pages per chunk
+            run_chunk: Function that runs the pipeline on a list of images,
+                called as `run_chunk(images, progress=progress, on_pages=on_pages)`
+            progress: Optional Gradio progress tracker
+            on_pages: Optional callback that receives finished pages, passed
+                on to run_chunk
+
+        Returns:
+            The processed collection
+        """
+        chunks = [images[i : i + chunk_size] for i in range(0, len(images), chunk_size)]
+        with tempfile.TemporaryDirectory(prefix="htrflow_chunks_") as spool_dir:
+            spooled = []
+            for i, chunk in enumerate(chunks):
+                logger.info(
+                    "Running chunk %d / %d (%d page(s))", i + 1, len(chunks), len(chunk)
+                )
+                chunk_progress = None
+                if progress:
+                    chunk_progress = _scaled_progress(
+                        progress, i / len(chunks), (i + 1) / len(chunks)
+                    )
+                # Each chunk has its own image store, removed once it is done
+                with job_image_store():
+                    collection = run_chunk(
+                        chunk, progress=chunk_progress, on_pages=on_pages
+                    )
+                for page in collection.pages:
+                    page.clear_images()
+                spooled.append(
+                    save_collection(
+                        collection, os.path.join(spool_dir, f"chunk_{i:05d}.pickle")
+                    )
+                )
+                del collection
+
+            pages = []
+            for path in spooled:
+                collection = load_collection(path)
+                pages.extend(collection.pages)
+        return subset_collection(collection, pages)
+
+    def resume(self, checkpoint_dir, progress=None, intermediate=None, on_pages=None):
+        """
+        Resume a job from its last checkpoint in checkpoint_dir.
+
+        Returns:
+            The processed collection, or None if there is no checkpoint to
+            resume from.
+        """
+        checkpoint = load_checkpoint(checkpoint_dir)
+        if checkpoint is None:
+            return None
+
+        collection, completed_steps = checkpoint
+        if completed_steps > len(self.steps):
+            return None
+        attach(collection)
+
+        logger.info(
+            "Resuming job from checkpoint after step %d / %d",
+            completed_steps,
+            len(self.steps),
+        )
+        return self.run(
+            collection,
+            start=completed_steps,
+            progress=progress,
+            checkpoint_dir=checkpoint_dir,
+            intermediate=intermediate,
+            on_pages=on_pages,
+        )
+
+
+def _lock_attempt(attempt_dir: str):
+    """
+    Take the lock of a checkpoint attempt directory without blocking.
+
+    Returns:
+        The open lock file, which holds the lock until it is closed, or None
+        if another attempt holds the lock or the directory is gone
+    """
+    try:
+        lock_file = open(os.path.join(attempt_dir, ".lock"), "a")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    # The directory may have been removed by its previous owner between
+    # opening and locking the file
+    if not os.path.exists(lock_file.name):
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def evict_checkpoints(keep: str, max_bytes: int = CHECKPOINT_MAX_MB * 1024**2):
+    """
+    Remove the least recently written checkpoint directories until
+    CHECKPOINT_DIR fits max_bytes.
+
+    Directories locked by a running attempt are never removed.
+    """
+    attempts = []
+    for attempt_dir in glob.glob(os.path.join(CHECKPOINT_DIR, "*")):
+        if attempt_dir == keep or not os.path.isdir(attempt_dir):
+            continue
+        try:
+            mtime = os.stat(attempt_dir).st_mtime
+            size = sum(
+                os.path.getsize(path)
+                for path in glob.glob(os.path.join(attempt_dir, "*"))
+            )
+        except FileNotFoundError:
+            continue
+        attempts.append((attempt_dir, mtime, size))
+
+    total_bytes = sum(size for _, _, size in attempts)
+    if keep:
+        total_bytes += sum(
+            os.path.getsize(path) for path in glob.glob(os.path.join(keep, "*"))
+        )
+    for attempt_dir, _mtime, size in sorted(attempts, key=lambda attempt: attempt[1]):
+        if total_bytes <= max_bytes:
+            break
+        lock_file = _lock_attempt(attempt_dir)
+        if lock_file is None:
+            continue
+        try:
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+        finally:
+            lock_file.close()
+        logger.info("Removed abandoned checkpoints in %s", attempt_dir)
+        total_bytes -= size
+
+
+@contextmanager
+def job_checkpoint_dir(config: dict, images: list[str]):
+    """
+    Claim a checkpoint directory for one attempt of a job.
+
+    Every attempt checkpoints into its own directory, named after the
+    pipeline steps and the input images, and holds an exclusive lock on it
+    while it runs. The lock is released when the attempt ends, also if its
+    process dies. A resubmitted job resumes from the checkpoints of an
+    earlier attempt that nobody holds, while identical jobs that run at the
+    same time get separate directories. Checkpoints of abandoned attempts
+    are evicted once they exceed CHECKPOINT_MAX_MB (see `evict_checkpoints`).
+
+    Yields:
+        The directory, or None if checkpointing is disabled
+    """
+    if not CHECKPOINT_DIR:
+        yield None
+        return
+
+    job_hash = config_hash({"steps": config["steps"], "images": images})
+    lock_file = None
+    for attempt_dir in glob.glob(os.path.join(CHECKPOINT_DIR, f"{job_hash}_*")):
+        if glob.glob(os.path.join(attempt_dir, "step_*.pickle")):
+            lock_file = _lock_attempt(attempt_dir)
+            if lock_file is not None:
+                break
+
+    if lock_file is None:
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        attempt_dir = tempfile.mkdtemp(prefix=f"{job_hash}_", dir=CHECKPOINT_DIR)
+        # Directories without checkpoints are never claimed by other jobs
+        lock_file = _lock_attempt(attempt_dir)
+
+    evict_checkpoints(keep=attempt_dir)
+    try:
+        yield attempt_dir
+    finally:
+        # Attempts that failed before their first checkpoint leave nothing
+        # to resume from
+        if not glob.glob(os.path.join(attempt_dir, "step_*.pickle")):
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+        if lock_file is not None:
+            lock_file.close()
+
+
+def save_checkpoint(collection, checkpoint_dir: str, completed_steps: int) -> str:
+    """
+    Save a checkpoint of a collection after completed_steps steps.
+
+    The step count is part of the file name, and older checkpoints are only
+    removed once the new one has been written.
+    """
+    path = save_collection(
+        collection, os.path.join(checkpoint_dir, f"step_{completed_steps:03d}.pickle")
+    )
+    for old_path in glob.glob(os.path.join(checkpoint_dir, "step_*.pickle")):
+        if old_path != path:
+            os.remove(old_path)
+    logger.info("Saved checkpoint after step %d to %s", completed_steps, path)
+    return path
+
+
+def load_checkpoint(checkpoint_dir: str):
+    """
+    Load the latest checkpoint in checkpoint_dir.
+
+    Returns:
+        A (collection, completed_steps) tuple, or None if no usable
+        checkpoint exists.
+    """
+    paths = sorted(glob.glob(os.path.join(checkpoint_dir, "step_*.pickle")))
+    if not paths:
+        return None
+
+    path = paths[-1]
+    completed_steps = int(os.path.basename(path)[len("step_") : -len(".pickle")])
+    try:
+        collection = load_collection(path)
+    except Exception:
+        logger.exception("Could not load checkpoint %s", path)
+        return None
+    return collection, completed_steps
 
-def pdf_to_images(pdf_path):
+
+def pdf_to_images(pdf_path, page_range=None, dpi=PDF_DPI):
     """
-    Convert a PDF file to a list of PIL Image objects using PyMuPDF.
-    Extracts full-resolution images with no DPI adjustment.
+    Render the pages of a PDF file for the PDF gallery.
+
+    Pages are processed one at a time and shown as soon as they are ready.
+    Pages that wrap a single scanned image are extracted at their native
+    resolution; other pages are rendered at the given resolution.
 
     Args:
         pdf_path (str): Path to the PDF file
+        page_range (str): Optional page selection, e.g. "1-5, 8". Empty for all pages.
+        dpi (int): Target resolution
+
+    Yields:
+        list: Thumbnails of the pages rendered so far
+    """
+    if not pdf_path:
+        return
+
+    pdf_dir = os.path.join(GRADIO_CACHE, "pdf")
+    output_dir = pdf_output_dir(pdf_path, int(dpi), pdf_dir)
+    try:
+        pages = render_pdf_to_files(pdf_path, output_dir, int(dpi), page_range)
+        images = []
+        # Only the rendering is timed, not the time the gallery takes to
+        # consume each update
+        render_seconds = 0.0
+        while True:
+            render_start = time.perf_counter()
+            path = next(pages, None)
+            render_seconds += time.perf_counter() - render_start
+            if path is None:
+                break
+            images.append(thumbnail(path))
+            INGEST_IMAGES.inc(source="pdf")
+            yield list(images)
+        INGEST_DURATION.observe(render_seconds, source="pdf")
+    except ValueError as e:
+        raise gr.Error(str(e))
+    finally:
+        evict_pdfs(pdf_dir, keep={output_dir})
+
+
+def run_pipeline(
+    config: dict, images: list[str], progress=None, on_pages=None
+) -> Collection:
+    """
+    Run an HTRflow pipeline on a list of images.
+
+    Jobs that are processed by the CPU worker pool run as a whole, since the
+    pool already handles one page at a time. Other jobs with more than
+    PIPELINE_CHUNK_PAGES images are run in chunks (see
+    `PipelineWithProgress.run_chunked`).
+
+    Args:
+        config: Pipeline config (the parsed YAML)
+        images: Paths or URLs of the images to process
+        progress: Optional Gradio progress tracker
+        on_pages: Optional callback that receives each page once it is
+            done (see `PipelineWithProgress.run`)
 
     Returns:
-        list: List of PIL Image objects
+        The processed collection
     """
-    pdf_document = fitz.open(pdf_path)
-    images = []
+    pipe = PipelineWithProgress.from_config(config)
+    if not use_process_pool(len(images)) and 0 < PIPELINE_CHUNK_PAGES < len(images):
+        return pipe.run_chunked(
+            sorted(images),
+            PIPELINE_CHUNK_PAGES,
+            lambda chunk, progress, on_pages: _run_job(
+                pipe, config, chunk, progress, on_pages
+            ),
+            progress=progress,
+            on_pages=on_pages,
+        )
+    return _run_job(pipe, config, images, progress, on_pages)
+
+
+def _run_job(
+    pipe: PipelineWithProgress,
+    config: dict,
+    images: list[str],
+    progress,
+    on_pages=None,
+):
+    """Run pipe on images, resuming from a checkpoint or cached steps if possible."""
+    intermediate = IntermediateResults(config["steps"])
+    with job_checkpoint_dir(config, images) as checkpoint_dir:
+        collection = None
+        if checkpoint_dir:
+            collection = pipe.resume(
+                checkpoint_dir,
+                progress=progress,
+                intermediate=intermediate,
+                on_pages=on_pages,
+            )
+
+        if collection is None:
+            # Skip the leading steps whose output is cached for all images
+            restored = intermediate.restore(images, label="demo_output")
+            if restored:
+                collection, start = restored
+                attach(collection)
+            else:
+                collection, start = new_collection(images, label="demo_output"), 0
+
+            collection = pipe.run(
+                collection,
+                start=start,
+                progress=progress,
+                checkpoint_dir=checkpoint_dir,
+                intermediate=intermediate,
+                on_pages=on_pages,
+            )
 
-    for page_num in range(len(pdf_document)):
-        page = pdf_document[page_num]
-        pixmap = page.get_pixmap(alpha=False)
-        img_data = pixmap.tobytes("jpeg")
-        img = Image.open(io.BytesIO(img_data))
-        images.append(img)
+        # Removed while the lock is held, so no other job claims it meanwhile
+        if checkpoint_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return collection
 
-    pdf_document.close()
-    return images
+
+# Scheduling layer in front of the pipeline: merges concurrent jobs with the
+# same config into one run (see app.batching)
+BATCHER = MicroBatcher(run_pipeline)
 
 
 @spaces.GPU
@@ -104,8 +647,12 @@ def run_htrflow(custom_template_yaml, batch_image_gallery, progress=gr.Progress(
     Args:
         custom_template_yaml (str): YAML string specifying the HTRflow pipeline configuration.
         batch_image_gallery (list): List of uploaded images to process in the pipeline.
-    Returns:
-        tuple: A collection of processed items, list of exported file paths, and a Gradio update object.
+    Yields:
+        tuple: The collection of the pages processed so far and a Gradio update object.
+            The job runs as one pipeline run on a background thread. A partial
+            collection is yielded whenever pages finish before the rest of the
+            job (cached pages, PDF text layers and pages whose last step is
+            done), and the complete collection last.
     """
 
     if custom_template_yaml is None or len(custom_template_yaml) < 1:
@@ -125,18 +672,63 @@ def run_htrflow(custom_template_yaml, batch_image_gallery, progress=gr.Progress(
     images = [temp_img[0] for temp_img in batch_image_gallery]
     logger.info("Starting HTR pipeline with %d image(s)", len(images))
 
-    collection = Collection(images)
-
-    pipe = PipelineWithProgress.from_config(config)
-
     gr.Info(
         f"HTRflow: processing {len(images)} {'image' if len(images) == 1 else 'images'}."
     )
+    # IIIF images are requested at the resolution the pipeline needs (the
+    # galleries hold thumbnails)
+    images = sized_image_urls(images, inference_side(config))
+
+    # Download all remote images up front and in parallel, instead of one
+    # at a time while the pipeline runs
+    remote = [image for image in images if is_remote(image)]
+    if remote:
+        progress(0.05, desc="HTRflow: Downloading images")
+        with INGEST_DURATION.time(source="url"):
+            downloaded = prefetch(remote)
+        INGEST_IMAGES.inc(len(downloaded), source="url")
+
     progress(0.1, desc="HTRflow: Processing")
 
-    collection.label = "demo_output"
+    finished = queue.SimpleQueue()
+
+    def emit(pages):
+        # Shown pages only need their results; their cached images, crops and
+        # stored images are released as soon as they are done
+        release_images(pages)
+        finished.put(pages)
+
+    def run_job():
+        # Each image is decoded once and shared by all steps
+        with job_image_store():
+            # Pages with a PDF text layer skip the pipeline and the result cache
+            return run_with_text_layers(
+                config,
+                images,
+                lambda config, images, progress, on_pages: run_with_result_cache(
+                    config, images, BATCHER.submit, progress=progress, on_pages=on_pages
+                ),
+                progress=_scaled_progress(progress, 0.1, 1),
+                on_pages=emit,
+            )
 
-    collection = pipe.run(collection, progress=progress)
+    # The job runs in the background while this generator yields the pages
+    # that are done. The copied context carries the Gradio progress tracker.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        job = executor.submit(contextvars.copy_context().run, run_job)
+        pages = []
+        while not job.done() or not finished.empty():
+            try:
+                pages.extend(finished.get(timeout=0.1))
+            except queue.Empty:
+                continue
+            collection = Collection([], label="demo_output")
+            collection.pages = sorted(pages, key=lambda page: page.path)
+            collection.pending_pages = len(images) - len(pages)
+            if collection.pending_pages > 0:
+                yield collection, gr.skip()
+        collection = job.result()
+    release_images(collection.pages)
 
     progress(1, desc="HTRflow: Finish, redirecting to 'Results tab'")
     time.sleep(2)
@@ -146,6 +738,42 @@ def run_htrflow(custom_template_yaml, batch_image_gallery, progress=gr.Progress(
     yield collection, gr.skip()
 
 
+def check_uploads(images: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Validate uploaded gallery images from their headers (see `validate_uploads`).
+
+    Duplicates, unreadable files and images too large to decode are dropped,
+    and images above the pixel budget are replaced by downsampled copies.
+    A warning is shown for each changed or dropped image.
+
+    Args:
+        images: (path, caption) tuples
+
+    Returns:
+        The (path, caption) tuples to keep
+    """
+    local = [
+        i
+        for i, image in enumerate(images)
+        if isinstance(image, (list, tuple)) and not is_remote(image[0])
+    ]
+    paths, issues = validate_uploads([images[i][0] for i in local])
+
+    messages = {
+        DOWNSAMPLED: _("Image was downscaled to fit the size limit"),
+        DUPLICATE: _("Removed duplicate image"),
+        TOO_LARGE: _("Image is too large and was removed"),
+        UNREADABLE: _("File is not a readable image and was removed"),
+    }
+    for path, reason in issues:
+        gr.Warning(f"{messages[reason]}: {os.path.basename(path)}")
+
+    kept = list(images)
+    for i, path in zip(local, paths):
+        kept[i] = (path, images[i][1]) if path else None
+    return [image for image in kept if image is not None]
+
+
 def get_pipeline_description(pipeline: str, language: str = "en") -> str:
     """
     Get the description of the given pipeline in the specified language.
@@ -177,21 +805,31 @@ def get_yaml(pipeline: str) -> str:
 
 def all_example_images() -> list[str]:
     """
-    Get paths to all example images.
+    Get paths to the thumbnails of all example images.
     """
     examples = []
     for pipeline in PIPELINES.values():
         for example in pipeline.get("examples", []):
-            examples.append(os.path.join(EXAMPLES_DIRECTORY, example))
+            examples.append(thumbnail(os.path.join(EXAMPLES_DIRECTORY, example)))
     return examples
 
 
+def _selected_full_image(event: gr.SelectData) -> str:
+    """Path to the full image of the selected gallery thumbnail."""
+    try:
+        return full_image(event.value["image"]["path"])
+    except FileNotFoundError as e:
+        logger.warning(e)
+        raise gr.Error(_("The original image could not be found"))
+
+
 def get_selected_example_image(event: gr.SelectData):
     """
     Get path to the selected example image with caption, and open in preview mode.
     """
-    image_path = event.value["image"]["path"]
-    caption = event.value["image"].get("orig_name") or os.path.basename(image_path)
+    # Galleries show thumbnails; the full image goes to the input gallery
+    image_path = _selected_full_image(event)
+    caption = event.value.get("caption") or os.path.basename(image_path)
     return gr.update(value=[(image_path, caption)], selected_index=0)
 
 
@@ -199,64 +837,62 @@ def get_selected_example_pipeline(event: gr.SelectData) -> str | None:
     """
     Get the name of the pipeline that corresponds to the selected image.
     """
+    image_path = _selected_full_image(event)
     for name, details in PIPELINES.items():
-        if event.value["image"]["orig_name"] in details.get("examples", []):
+        if os.path.basename(image_path) in details.get("examples", []):
             return name
 
 
 def get_image_from_image_id(image_id):
-    url = f"https://lbiiif.riksarkivet.se/arkis!{image_id}/full/max/0/default.jpg"
+    url = iiif_image_url(f"https://lbiiif.riksarkivet.se/arkis!{image_id}")
+    # Preview a thumbnail; the job requests the resolution the pipeline needs
+    url = sized_image_url(url, IIIF_THUMBNAIL_SIDE)
     return gr.update(value=[(url, image_id)], selected_index=0)
 
 
-def get_images_from_iiif_manifest(iiif_manifest_url, max_images=20, height=1200):
+def get_images_from_iiif_manifest(iiif_manifest_url, max_images=20, canvas_range=None):
     """
-    Read images from a v2/v3 IIIF manifest, limited to max_images.
+    Read images from a v2/v3 IIIF manifest, in canvas order.
+
+    The manifest is parsed while it is downloaded, and the download stops
+    once the selected canvases have been read. The gallery shows thumbnails;
+    jobs request the images at the resolution their pipeline needs.
 
     Arguments:
         iiif_manifest_url: URL to IIIF manifest
-        height: Max height of returned images
-        max_images: Maximum number of images to return (default: 20)
+        max_images: Maximum number of images to return when no canvases
+            are selected (default: 20)
+        canvas_range: Optional selection of canvases, e.g. "40-80". All
+            selected canvases are returned. Leave empty to read the first
+            max_images canvases.
     """
+    ingest_start = time.perf_counter()
+    # An explicit selection is not cut down to the default number of images
+    max_canvases = None
+    if max_images and not (canvas_range and canvas_range.strip()):
+        max_canvases = int(max_images)
     try:
-        buffer = io.BytesIO()
-        c = pycurl.Curl()
-
-        c.setopt(c.URL, iiif_manifest_url)
-        c.setopt(c.WRITEDATA, buffer)
-        c.setopt(c.CAINFO, certifi.where())
-        c.setopt(c.FOLLOWLOCATION, 1)
-        c.setopt(c.MAXREDIRS, 5)
-        c.setopt(c.CONNECTTIMEOUT, 5)
-        c.setopt(c.TIMEOUT, 10)
-        c.setopt(c.NOSIGNAL, 1)
-        c.setopt(c.USERAGENT, "curl/7.68.0")
-
-        c.perform()
-
-        http_code = c.getinfo(c.RESPONSE_CODE)
-        if http_code != 200:
-            raise Exception(f"HTTP Error: {http_code}")
-
-        manifest = buffer.getvalue().decode("utf-8")
-        c.close()
-
-    except pycurl.error as e:
-        error_code, error_msg = e.args
-        raise Exception(
-            f"Could not fetch IIIF manifest from {iiif_manifest_url} ({error_msg})"
+        canvases = fetch_manifest_canvases(
+            iiif_manifest_url, canvas_range, max_canvases
         )
-
-    pattern = r'(?P<identifier>https?://[^"\s]*)/(?P<region>[^"\s]*?)/(?P<size>[^"\s]*?)/(?P<rotation>!?\d*?)/(?P<quality>[^"\s]*?)\.(?P<format>jpg|tif|png|gif|jp2|pdf|webp)'
-    images = set()
-
-    for match in re.findall(pattern, manifest):
-        identifier, _, _, _, _, format_ = match
-        images.add(f"{identifier}/full/{height},/0/default.{format_}")
-        if len(images) >= max_images:
-            break
-
-    return sorted(images)[:max_images], gr.update(visible=True)
+    except ValueError as e:
+        raise gr.Error(str(e))
+    except (ConnectionError, OSError, pycurl.error) as e:
+        logger.warning("Could not load IIIF manifest %s: %s", iiif_manifest_url, e)
+        raise gr.Error(f"{_('Could not load the IIIF manifest')}: {e}")
+
+    urls, labels = [], []
+    for number, canvas in canvases:
+        service, resource = canvas_image(canvas)
+        url = iiif_image_url(service) if service else resource
+        if url:
+            urls.append(url)
+            labels.append(canvas_label(canvas) or str(number))
+    images = list(zip(sized_image_urls(urls, IIIF_THUMBNAIL_SIDE), labels))
+
+    INGEST_DURATION.observe(time.perf_counter() - ingest_start, source="iiif")
+    INGEST_IMAGES.inc(len(images), source="iiif")
+    return images, gr.update(visible=True)
 
 
 with gr.Blocks() as submit:
@@ -325,6 +961,14 @@ with gr.Blocks() as submit:
                             minimum=1,
                             visible=False,
                         )
+                        iiif_canvases = gr.Textbox(
+                            label=_("Canvases"),
+                            info=_(
+                                "Canvases to read, e.g. 40-80. Leave empty to start from the first."
+                            ),
+                            placeholder="40-80",
+                            scale=0,
+                        )
                     iiif_gallery = gr.Gallery(
                         interactive=False,
                         columns=4,
@@ -343,6 +987,21 @@ with gr.Blocks() as submit:
 
                 with gr.Tab(_("PDF")):
                     pdf_file = gr.File(label=_("PDF"), file_types=[".pdf"])
+                    with gr.Row():
+                        pdf_pages = gr.Textbox(
+                            label=_("Pages"),
+                            info=_(
+                                "Pages to render, e.g. 1-5, 8. Leave empty for all pages."
+                            ),
+                            placeholder="1-5, 8",
+                        )
+                        pdf_dpi = gr.Number(
+                            value=PDF_DPI,
+                            label=_("Resolution (DPI)"),
+                            minimum=72,
+                            maximum=600,
+                            precision=0,
+                        )
 
                     pdf_gallery = gr.Gallery(
                         interactive=False,
@@ -439,6 +1098,7 @@ with gr.Blocks() as submit:
             else:
                 processed_images.append(img)
 
+        processed_images = check_uploads(processed_images)
         return gr.update(
             value=processed_images, selected_index=0 if processed_images else None
         )
@@ -453,10 +1113,11 @@ with gr.Blocks() as submit:
         outputs=pipeline_dropdown,
         api_visibility="private",
     )
-    iiif_manifest_url.submit(
+    gr.on(
+        [iiif_manifest_url.submit, iiif_canvases.submit],
         get_images_from_iiif_manifest,
-        [iiif_manifest_url, max_images_iiif_manifest],
-        [iiif_gallery, max_images_iiif_manifest],
+        inputs=[iiif_manifest_url, max_images_iiif_manifest, iiif_canvases],
+        outputs=[iiif_gallery, max_images_iiif_manifest],
         api_visibility="private",
     )
     image_url.submit(
@@ -466,9 +1127,10 @@ with gr.Blocks() as submit:
         api_visibility="private",
     )
 
-    pdf_file.upload(
-        lambda imgs: pdf_to_images(imgs),
-        inputs=pdf_file,
+    gr.on(
+        [pdf_file.upload, pdf_pages.submit],
+        pdf_to_images,
+        inputs=[pdf_file, pdf_pages, pdf_dpi],
         outputs=pdf_gallery,
         api_visibility="private",
     )
@@ -478,6 +1140,7 @@ with gr.Blocks() as submit:
         inputs=[custom_template_yaml, batch_image_gallery],
         outputs=[collection_submit_state, batch_image_gallery],
         api_visibility="private",
+        concurrency_limit=HTR_CONCURRENCY,
     )
 
     examples.select(
@@ -5,9 +5,17 @@ from pathlib import Path
 
 import gradio as gr
 from htrflow.volume.volume import Collection
-from htrflow.results import RecognizedText, TEXT_RESULT_KEY
 from gradio_i18n import gettext as _
 
+from app.metrics import EXPORT_DURATION, EXPORT_FILES
+from app.visualizer_pages import (
+    VISUALIZER_PAGES_PATH,
+    edit_version,
+    page_payload,
+    page_summary,
+    register_collection,
+)
+
 logger = logging.getLogger(__name__)
 
 current_dir = Path(__file__).parent
@@ -25,14 +33,13 @@ def load_file(filename):
 class HTRVisualizer(gr.HTML):
     """Unified HTR visualization with synchronized image and transcription panels"""
 
-    def __init__(self, max_height="70vh", layout="auto", edits=None, **kwargs):
+    def __init__(self, max_height="70vh", layout="auto", **kwargs):
         html_template = load_file("template.html")
         css_template = load_file("visualizer.css")
         js_on_load = load_file("visualizer.js")
 
         super().__init__(
             value={"width": 100, "height": 100, "path": "", "lines": [], "regions": []},
-            edits=edits or {},
             html_template=html_template,
             css_template=css_template,
             js_on_load=js_on_load,
@@ -48,6 +55,7 @@ class HTRVisualizer(gr.HTML):
                 "width": {"type": "integer"},
                 "height": {"type": "integer"},
                 "path": {"type": "string"},
+                "imageUrl": {"type": "string"},
                 "lines": {
                     "type": "array",
                     "items": {
@@ -75,48 +83,32 @@ class HTRVisualizer(gr.HTML):
         }
 
 
-def prepare_visualizer_data(collection: Collection, current_page_index: int):
-    all_pages = []
-
-    for page_idx, page in enumerate(collection.pages):
-        lines = list(page.traverse(lambda node: node.is_line()))
-
-        regions_raw = page.traverse(
-            lambda node: node.children and all(child.is_line() for child in node)
-        )
+def prepare_visualizer_data(
+    collection: Collection, current_page_index: int, request: gr.Request
+):
+    """
+    Build the visualizer value of a collection.
 
-        line_counter = 0
-        region_data = []
-        for region in regions_raw:
-            region_lines = []
-            for line in region:
-                region_lines.append({"id": line_counter, "text": line.text})
-                line_counter += 1
-            region_data.append(region_lines)
-
-        all_pages.append(
-            {
-                "width": page.width,
-                "height": page.height,
-                "path": page.path,
-                "label": page.label,
-                "lines": [
-                    {
-                        "polygonPoints": " ".join(
-                            [f"{p[0]},{p[1]}" for p in line.polygon]
-                        ),
-                        "id": idx,
-                    }
-                    for idx, line in enumerate(lines)
-                ],
-                "regions": region_data,
-            }
-        )
+    Only the current page comes with its lines and regions; the other pages
+    carry their metadata and are fetched from `pagesUrl` when they are
+    shown. Text edits are posted back to `pagesUrl` as patches against
+    `editVersion` (see app.visualizer_pages). The collection is registered
+    for the session, replacing the one it displayed before.
+    """
+    session = getattr(request, "session_hash", None) or f"collection-{id(collection)}"
+    token = register_collection(collection, session)
+    all_pages = [page_summary(page) for page in collection.pages]
+    if 0 <= current_page_index < len(all_pages):
+        all_pages[current_page_index].update(page_payload(token, current_page_index))
 
     return {
         "pages": all_pages,
+        "pagesUrl": f"{VISUALIZER_PAGES_PATH}/{token}",
+        "editVersion": edit_version(token),
         "currentPageIndex": current_page_index,
         "totalPages": len(collection.pages),
+        # Pages of a running job that are still being processed
+        "pendingPages": getattr(collection, "pending_pages", 0),
     }
 
 
@@ -171,8 +163,10 @@ def export_and_download(file_format, collection: Collection, req: gr.Request):
     temp_user_dir.mkdir(exist_ok=True)
 
     temp_user_file_dir = os.path.join(temp_user_dir, file_format)
-    collection.save(directory=temp_user_file_dir, serializer=file_format)
-    exported_files = rename_files_in_directory(temp_user_file_dir, file_format)
+    with EXPORT_DURATION.time(format=file_format):
+        collection.save(directory=temp_user_file_dir, serializer=file_format)
+        exported_files = rename_files_in_directory(temp_user_file_dir, file_format)
+    EXPORT_FILES.inc(len(exported_files), format=file_format)
 
     if exported_files and len(exported_files) > 0:
         if len(exported_files) > 1:
@@ -195,49 +189,12 @@ def export_and_download(file_format, collection: Collection, req: gr.Request):
     return None
 
 
-def apply_text_edits(collection: Collection, visualizer_value: dict):
-    """Apply text edits from the visualizer to the collection"""
-    edit_data = (
-        visualizer_value.get("edits", {}) if isinstance(visualizer_value, dict) else {}
-    )
-
-    if not edit_data:
-        return collection
-
-    # Edits are keyed as "pageIndex_lineId"
-    for edit_key, new_text in edit_data.items():
-        page_idx_str, line_id_str = edit_key.split("_")
-        page_idx = int(page_idx_str)
-        line_id = int(line_id_str)
-
-        if 0 <= page_idx < len(collection.pages):
-            page = collection[page_idx]
-            lines = list(page.traverse(lambda node: node.is_line()))
-
-            if 0 <= line_id < len(lines):
-                line = lines[line_id]
-                old_result = line.get(TEXT_RESULT_KEY)
-                score = (
-                    old_result.scores[0]
-                    if (
-                        old_result
-                        and hasattr(old_result, "scores")
-                        and old_result.scores
-                    )
-                    else 1.0
-                )
-                line.add_data(**{TEXT_RESULT_KEY: RecognizedText([new_text], [score])})
-
-    return collection
-
-
 with gr.Blocks() as visualizer:
     gr.Markdown(_("visualizer_description"))
 
     visualizer_component = HTRVisualizer(
         max_height="70vh",
         layout="auto",
-        edits={},
     )
 
     with gr.Row(equal_height=True):
@@ -276,16 +233,6 @@ with gr.Blocks() as visualizer:
     collection = gr.State()
     current_page_index = gr.State(0)
 
-    def check_and_apply_edits(coll, viz_value):
-        """Check if visualizer value has edits and apply them"""
-        if isinstance(viz_value, dict) and "edits" in viz_value and viz_value["edits"]:
-            updated_coll = apply_text_edits(coll, viz_value)
-            viz_data = prepare_visualizer_data(updated_coll, 0)
-
-            gr.Info("✅ Edits saved successfully!")
-            return updated_coll, viz_data
-        return coll, gr.update()
-
     collection.change(
         prepare_visualizer_data,
         inputs=[collection, current_page_index],
@@ -293,13 +240,6 @@ with gr.Blocks() as visualizer:
         api_visibility="private",
     )
 
-    visualizer_component.change(
-        fn=check_and_apply_edits,
-        inputs=[collection, visualizer_component],
-        outputs=[collection, visualizer_component],
-        api_visibility="private",
-    )
-
     export_button.click(
         fn=export_and_download,
         inputs=[export_file_format, collection],
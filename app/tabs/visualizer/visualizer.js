@@ -1,10 +1,21 @@
 (() => {
-    const initVisualizer = () => {
+    // Listeners of the previous initialization are removed when the
+    // visualizer is re-initialized with new data
+    let initController = null;
+    let lastPageIndex = null;
+
+    const initVisualizer = (keepPage = false) => {
         if (!props.value || !props.value.pages || props.value.pages.length === 0) {
             setTimeout(initVisualizer, 100);
             return;
         }
 
+        if (initController) initController.abort();
+        initController = new AbortController();
+        const { signal } = initController;
+        const on = (target, type, handler, options = {}) =>
+            target.addEventListener(type, handler, { ...options, signal });
+
         const svgContainer = element.querySelector('.svg-container');
         const transcriptionPanel = element.querySelector('.transcription-panel');
         const pageInfoEl = element.querySelector('#page-info');
@@ -12,8 +23,13 @@
         const nextBtn = element.querySelector('#nav-next-btn');
 
         let currentPageIndex = props.value.currentPageIndex || 0;
+        if (keepPage && lastPageIndex !== null && lastPageIndex < props.value.pages.length) {
+            currentPageIndex = lastPageIndex;
+        }
         let selectedLineId = null;
         let editedTexts = {};
+        // Text of each edited line before it was edited, to detect conflicts
+        let originalTexts = {};
         let isEditMode = false;
 
         let viewBox = { x: 0, y: 0, width: 0, height: 0 };
@@ -25,15 +41,78 @@
         let touchStartDistance = 0;
         let touchStartViewBox = { x: 0, y: 0, width: 0, height: 0 };
         let touchStartCenter = { x: 0, y: 0 };
-        function renderPage(pageIndex) {
+
+        // Lines and regions of the pages fetched so far. Only the current
+        // page is sent with the value; other pages are fetched on demand.
+        const pageCache = {};
+        const pageRequests = {};
+        // Edit version of the collection that the saved edits apply to
+        let editVersion = props.value.editVersion || 0;
+
+        function pageDetails(pageIndex) {
             const page = props.value.pages[pageIndex];
-            if (!page) return;
+            if (!page) return null;
+            if (page.lines) return page;
+            return pageCache[pageIndex] || null;
+        }
+
+        function fetchPage(pageIndex) {
+            return fetch(`${props.value.pagesUrl}/${pageIndex}`, { signal })
+                .then((response) => {
+                    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                    return response.json();
+                })
+                .then((data) => {
+                    const page = props.value.pages[pageIndex];
+                    if (page.lines) return Object.assign(page, data);
+                    pageCache[pageIndex] = { ...page, ...data };
+                    return pageCache[pageIndex];
+                });
+        }
+
+        function loadPage(pageIndex) {
+            const details = pageDetails(pageIndex);
+            if (details) return Promise.resolve(details);
+            if (!pageRequests[pageIndex]) {
+                pageRequests[pageIndex] = fetchPage(pageIndex).finally(() => {
+                    delete pageRequests[pageIndex];
+                });
+            }
+            return pageRequests[pageIndex];
+        }
+
+        function lineText(pageIndex, lineId) {
+            const details = pageDetails(pageIndex);
+            if (!details) return undefined;
+            for (const region of details.regions) {
+                const line = region.find((l) => l.id === lineId);
+                if (line) return line.text;
+            }
+            return undefined;
+        }
+
+        function renderPage(pageIndex) {
+            if (!props.value.pages[pageIndex]) return;
+            lastPageIndex = pageIndex;
+
+            const page = pageDetails(pageIndex);
+            if (!page) {
+                if (pageInfoEl) pageInfoEl.textContent = `Image ${pageIndex + 1} of ${props.value.totalPages}: loading…`;
+                loadPage(pageIndex)
+                    .then(() => {
+                        if (currentPageIndex === pageIndex) renderPage(pageIndex);
+                    })
+                    .catch((error) => {
+                        if (error.name !== 'AbortError') console.error('Could not load page', pageIndex, error);
+                    });
+                return;
+            }
 
             viewBox = { x: 0, y: 0, width: page.width, height: page.height };
 
             svgContainer.innerHTML = `
                 <svg class="image-svg" viewBox="0 0 ${page.width} ${page.height}" xmlns="http://www.w3.org/2000/svg" preserveAspectRatio="xMidYMid meet">
-                    <image height="${page.height}" width="${page.width}" href="/gradio_api/file=${page.path}" />
+                    <image height="${page.height}" width="${page.width}" href="${page.imageUrl || `/gradio_api/file=${page.path}`}" />
                     ${page.lines.map((line) => `
                         <a class="textline" data-line-id="${line.id}">
                             <polygon points="${line.polygonPoints}"/>
@@ -56,7 +135,9 @@
             `).join('');
 
             if (pageInfoEl) {
-                pageInfoEl.textContent = `Image ${pageIndex + 1} of ${props.value.totalPages}: ${page.label}`;
+                const pending = props.value.pendingPages || 0;
+                pageInfoEl.textContent = `Image ${pageIndex + 1} of ${props.value.totalPages}: ${page.label}`
+                    + (pending > 0 ? ` (${pending} more processing…)` : '');
             }
 
             if (prevBtn) prevBtn.disabled = pageIndex <= 0;
@@ -70,6 +151,83 @@
             }
 
             selectedLineId = null;
+
+            // Fetch the next page in the background
+            if (pageIndex + 1 < props.value.pages.length) {
+                loadPage(pageIndex + 1).catch(() => {});
+            }
+        }
+
+        function applyEditsToCache(edits) {
+            // Keep fetched pages in line with the saved edits, so that
+            // revisiting a page shows the edited text
+            edits.forEach(({ page: pageIndex, line: lineId, text }) => {
+                const details = pageDetails(pageIndex);
+                if (!details) return;
+                details.regions.forEach((region) => region.forEach((line) => {
+                    if (line.id === lineId) line.text = text;
+                }));
+            });
+        }
+
+        function postEdits(edits) {
+            const patch = edits.map(({ page, line, text }) => ({ page, line, text }));
+            return fetch(`${props.value.pagesUrl}/edits`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ version: editVersion, edits: patch }),
+            })
+                .then((response) => response.json().then((data) => ({ status: response.status, data })));
+        }
+
+        function mergeEdits(edits, version) {
+            // Someone else saved edits since this page was loaded. Fetch the
+            // current text of the edited pages: lines that were changed in
+            // the meantime are conflicts and are not sent; the other edits
+            // are sent again against the current version.
+            editVersion = version;
+            Object.keys(pageCache).forEach((key) => delete pageCache[key]);
+            const pages = [...new Set(edits.map((edit) => edit.page))];
+            return Promise.all(pages.map(fetchPage)).then(() => {
+                const conflicts = [];
+                const merged = [];
+                edits.forEach((edit) => {
+                    const serverText = lineText(edit.page, edit.line);
+                    if (serverText === edit.text) return;
+                    if (serverText !== edit.original) {
+                        conflicts.push(edit);
+                    } else {
+                        merged.push(edit);
+                    }
+                });
+                if (merged.length === 0) return { version: editVersion, applied: 0, conflicts, merged: true };
+                return saveEdits(merged, false).then((data) => ({ ...data, conflicts, merged: true }));
+            });
+        }
+
+        function saveEdits(edits, merge = true) {
+            // Send only the changed lines. The server rejects a patch made
+            // against an older edit version with 409 and its current version.
+            return postEdits(edits).then(({ status, data }) => {
+                if (status === 409 && data.pending) {
+                    // Partial results of a running job cannot be edited
+                    throw new Error(data.error);
+                }
+                if (status === 409 && merge) return mergeEdits(edits, data.version);
+                if (status !== 200) throw new Error(data.error || `HTTP ${status}`);
+                editVersion = data.version;
+                applyEditsToCache(edits);
+                return { ...data, conflicts: [] };
+            });
+        }
+
+        function showStatus(message) {
+            if (!pageInfoEl) return;
+            const text = pageInfoEl.textContent;
+            pageInfoEl.textContent = message;
+            setTimeout(() => {
+                if (pageInfoEl.textContent === message) pageInfoEl.textContent = text;
+            }, 2000);
         }
         function updateViewBox() {
             const imageSvg = element.querySelector('.image-svg');
@@ -194,10 +352,13 @@
             if (newText !== originalText) {
                 const editKey = `${currentPageIndex}_${lineId}`;
                 editedTexts[editKey] = newText;
+                if (!(editKey in originalTexts)) {
+                    originalTexts[editKey] = lineText(currentPageIndex, Number(lineId));
+                }
             }
         }
         element.querySelectorAll('.zoom-btn').forEach(btn => {
-            btn.addEventListener('click', (e) => {
+            on(btn, 'click', (e) => {
                 e.stopPropagation();
                 const action = btn.dataset.action;
                 const page = props.value.pages[currentPageIndex];
@@ -250,9 +411,9 @@
             }
         };
 
-        document.addEventListener('keydown', handleKeyDown);
-        document.addEventListener('keyup', handleKeyUp);
-        svgContainer.addEventListener('mousedown', (e) => {
+        on(document, 'keydown', handleKeyDown);
+        on(document, 'keyup', handleKeyUp);
+        on(svgContainer, 'mousedown', (e) => {
             if (!e.ctrlKey && !e.metaKey) return;
             if (e.target.closest('.textline')) return;
 
@@ -268,17 +429,17 @@
             e.preventDefault();
         });
 
-        svgContainer.addEventListener('mouseleave', () => {
+        on(svgContainer, 'mouseleave', () => {
             isPanning = false;
             svgContainer.classList.remove('panning');
         });
 
-        svgContainer.addEventListener('mouseup', () => {
+        on(svgContainer, 'mouseup', () => {
             isPanning = false;
             svgContainer.classList.remove('panning');
         });
 
-        svgContainer.addEventListener('mousemove', (e) => {
+        on(svgContainer, 'mousemove', (e) => {
             if (e.ctrlKey || e.metaKey) {
                 isCtrlPressed = true;
                 if (!isPanning) svgContainer.classList.add('can-pan');
@@ -308,7 +469,7 @@
 
             updateViewBox();
         });
-        svgContainer.addEventListener('wheel', (e) => {
+        on(svgContainer, 'wheel', (e) => {
             e.preventDefault();
 
             const page = props.value.pages[currentPageIndex];
@@ -356,7 +517,7 @@
                 y: (touch1.clientY + touch2.clientY) / 2
             };
         }
-        svgContainer.addEventListener('touchstart', (e) => {
+        on(svgContainer, 'touchstart', (e) => {
             if (e.touches.length === 2) {
                 e.preventDefault();
                 isTouchPanning = true;
@@ -376,7 +537,7 @@
             }
         }, { passive: false });
 
-        svgContainer.addEventListener('touchmove', (e) => {
+        on(svgContainer, 'touchmove', (e) => {
             if (e.touches.length === 2 && isTouchPanning) {
                 e.preventDefault();
 
@@ -413,7 +574,7 @@
             }
         }, { passive: false });
 
-        svgContainer.addEventListener('touchend', (e) => {
+        on(svgContainer, 'touchend', (e) => {
             if (e.touches.length < 2) {
                 isTouchPanning = false;
             }
@@ -422,47 +583,70 @@
         const saveBtn = element.querySelector('#save-edits-btn');
 
         if (editToggle && saveBtn) {
-            editToggle.addEventListener('change', (e) => {
+            on(editToggle, 'change', (e) => {
                 const isEnabled = e.target.checked;
                 toggleEditMode(isEnabled);
                 saveBtn.style.display = isEnabled ? 'inline-flex' : 'none';
 
                 if (!isEnabled) {
                     editedTexts = {};
+                    originalTexts = {};
                     element.querySelectorAll('.transcription-line').forEach(line => {
                         line.classList.remove('edited');
                     });
                 }
             });
 
-            saveBtn.addEventListener('click', () => {
-                const editsCopy = JSON.parse(JSON.stringify(editedTexts));
-
-                const currentValue = props.value || {};
-                const newValue = {
-                    ...currentValue,
-                    edits: editsCopy
-                };
-                props.value = newValue;
-
-                trigger('change');
+            on(saveBtn, 'click', () => {
+                const edits = Object.entries(editedTexts).map(([key, text]) => {
+                    const [page, line] = key.split('_').map(Number);
+                    return { page, line, text, original: originalTexts[key] };
+                });
+                const unsaved = { editedTexts, originalTexts };
+                if (edits.length > 0) {
+                    saveEdits(edits)
+                        .then(({ conflicts, merged }) => {
+                            // Show the edits others saved in the meantime
+                            if (merged) renderPage(currentPageIndex);
+                            if (conflicts.length > 0) {
+                                const message = `⚠️ ${conflicts.length} line(s) were changed by someone else and were not saved`;
+                                showStatus(message);
+                                alert(`${message}:\n\n${conflicts.map((edit) => `Image ${edit.page + 1}: ${edit.text}`).join('\n')}`);
+                                return;
+                            }
+                            element.querySelectorAll('.transcription-line').forEach((lineEl) => {
+                                const edit = edits.find((e) => e.page === currentPageIndex
+                                    && e.line === Number(lineEl.dataset.lineId));
+                                if (edit) lineEl.dataset.originalText = edit.text;
+                            });
+                            showStatus('✅ Edits saved');
+                        })
+                        .catch((error) => {
+                            console.error('Could not save edits:', error);
+                            showStatus(`⚠️ Could not save edits: ${error.message}`);
+                            // Keep the edits, so that they can be saved again
+                            editedTexts = { ...unsaved.editedTexts, ...editedTexts };
+                            originalTexts = { ...unsaved.originalTexts, ...originalTexts };
+                        });
+                }
 
                 editToggle.checked = false;
                 toggleEditMode(false);
                 saveBtn.style.display = 'none';
 
                 editedTexts = {};
+                originalTexts = {};
                 element.querySelectorAll('.transcription-line').forEach(line => {
                     line.classList.remove('edited');
                 });
             });
         }
         if (prevBtn) {
-            prevBtn.addEventListener('click', navigateToPrevious);
+            on(prevBtn, 'click', navigateToPrevious);
         }
 
         if (nextBtn) {
-            nextBtn.addEventListener('click', navigateToNext);
+            on(nextBtn, 'click', navigateToNext);
         }
 
         const fullscreenBtn = element.querySelector('#fullscreen-btn');
@@ -479,7 +663,7 @@
                 visualizerRoot.classList.toggle('is-fullscreen', isFs);
             }
 
-            fullscreenBtn.addEventListener('click', (e) => {
+            on(fullscreenBtn, 'click', (e) => {
                 e.stopPropagation();
                 if (document.fullscreenElement) {
                     document.exitFullscreen();
@@ -488,7 +672,7 @@
                 }
             });
 
-            document.addEventListener('fullscreenchange', updateFullscreenIcon);
+            on(document, 'fullscreenchange', updateFullscreenIcon);
         }
 
         renderPage(currentPageIndex);
@@ -496,15 +680,27 @@
 
     function getDataFingerprint(val) {
         if (!val || !val.pages || val.pages.length === 0) return null;
-        return val.pages.map(p => p.path).join('|') + '|' + val.totalPages;
+        // The URL stays the same for a session; a new collection gets a new edit version
+        return val.pages.map(p => p.path).join('|') + '|' + val.totalPages + '|' + (val.pendingPages || 0)
+            + '|' + (val.pagesUrl || '') + '|' + (val.editVersion || 0);
+    }
+
+    function getPagePaths(val) {
+        return val && val.pages ? val.pages.map(p => p.path) : [];
     }
 
     let lastFingerprint = getDataFingerprint(props.value);
+    let lastPaths = getPagePaths(props.value);
     setInterval(() => {
         const currentFingerprint = getDataFingerprint(props.value);
         if (currentFingerprint && currentFingerprint !== lastFingerprint) {
+            // Stay on the current page when new pages of the same job arrive
+            const currentPaths = getPagePaths(props.value);
+            const isContinuation = lastPaths.length > 0
+                && lastPaths.every((path, i) => currentPaths[i] === path);
             lastFingerprint = currentFingerprint;
-            initVisualizer();
+            lastPaths = currentPaths;
+            initVisualizer(isContinuation);
         }
     }, 100);
 
@@ -0,0 +1,210 @@
+"""
+Text layers of PDF pages.
+
+Born-digital PDF pages, and scans that were OCR'd before upload, already
+carry their text with line geometry. During PDF ingestion, the text layer of
+such pages is saved in a registry keyed by the hash of the page image file.
+When a job runs, images with a registered text layer are turned directly
+into pages with regions and text lines, and only the remaining images go
+through the HTR pipeline.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+
+import fitz  # PyMuPDF
+from htrflow.results import Result
+from htrflow.volume.volume import Collection
+
+from app.collection_utils import subset_collection
+from app.image_store import new_collection
+
+logger = logging.getLogger(__name__)
+
+# Directory of the text layer registry
+TEXT_LAYER_DIR = os.environ.get("PDF_TEXT_LAYER_DIR", ".htrflow_cache/text_layers")
+
+# Minimum number of characters for a page's text layer to be used instead
+# of HTR. Set to 0 to always run HTR on PDF pages.
+PDF_TEXT_MIN_CHARS = int(os.environ.get("PDF_TEXT_MIN_CHARS", 20))
+
+# Text layers with a larger share of unmapped characters are not used
+_MAX_UNMAPPED_SHARE = 0.1
+
+_METADATA = {"model": "pdf-text-layer"}
+
+
+def file_digest(path: str) -> str:
+    """sha256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _registry_path(digest: str) -> str:
+    return os.path.join(TEXT_LAYER_DIR, f"{digest}.json")
+
+
+def extract_text_layer(page: fitz.Page, transform: fitz.Matrix) -> list[dict] | None:
+    """
+    Extract the text blocks and lines of a PDF page.
+
+    Args:
+        page: The PDF page
+        transform: Maps page coordinates to pixel coordinates of the page image
+
+    Returns:
+        A list of blocks, each with a "bbox" and a list of "lines" (each with
+        a "bbox" and a "text"), in reading order. None if the page has no
+        usable text layer.
+    """
+    if not PDF_TEXT_MIN_CHARS or page.rotation:
+        return None
+
+    blocks = []
+    n_chars = n_unmapped = 0
+    for block in page.get_text("dict", sort=True)["blocks"]:
+        if block["type"] != 0:
+            continue
+        lines = []
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            rect = fitz.Rect(line["bbox"]) * transform
+            if not text or rect.is_empty:
+                continue
+            n_chars += len(text)
+            n_unmapped += text.count("\ufffd")
+            lines.append({"bbox": [round(v) for v in rect], "text": text})
+        if lines:
+            rect = fitz.Rect(block["bbox"]) * transform
+            blocks.append({"bbox": [round(v) for v in rect], "lines": lines})
+
+    if n_chars < PDF_TEXT_MIN_CHARS or n_unmapped > _MAX_UNMAPPED_SHARE * n_chars:
+        return None
+    return blocks
+
+
+def save_text_layer(image_path: str, blocks: list[dict]):
+    """Register the text layer of the page image at image_path."""
+    os.makedirs(TEXT_LAYER_DIR, exist_ok=True)
+    path = _registry_path(file_digest(image_path))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"blocks": blocks}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+@functools.lru_cache(maxsize=1024)
+def _load_text_layer(path: str, mtime: float) -> list[dict] | None:
+    registry_path = _registry_path(file_digest(path))
+    if not os.path.exists(registry_path):
+        return None
+    with open(registry_path, encoding="utf-8") as f:
+        return json.load(f)["blocks"]
+
+
+def text_layer(image_path: str) -> list[dict] | None:
+    """Get the registered text layer of an image, or None if it has none."""
+    if not os.path.isdir(TEXT_LAYER_DIR):
+        return None
+    try:
+        return _load_text_layer(image_path, os.path.getmtime(image_path))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _relative(bbox: list[int], origin: list[int]) -> list[int]:
+    x, y = origin[:2]
+    return [bbox[0] - x, bbox[1] - y, bbox[2] - x, bbox[3] - y]
+
+
+def _nonempty(items: list[dict]) -> list[dict]:
+    # htrflow drops segments with an empty area
+    return [
+        item
+        for item in items
+        if item["bbox"][2] > item["bbox"][0] and item["bbox"][3] > item["bbox"][1]
+    ]
+
+
+def text_layer_collection(images: list[str], label: str) -> Collection:
+    """
+    Create a collection from images with registered text layers.
+
+    Each text block becomes a region and each text line a line node with
+    the text of the layer, so the pages look like the output of a nested
+    segmentation and text recognition pipeline.
+    """
+    collection = new_collection(images, label=label)
+    for page in collection.pages:
+        blocks = _nonempty(text_layer(page.path))
+        shape = (page.height, page.width)
+        page.update(
+            Result.segmentation_result(
+                shape,
+                _METADATA,
+                bboxes=[block["bbox"] for block in blocks],
+                labels=["text_block"] * len(blocks),
+            )
+        )
+        for region, block in zip(page.children, blocks):
+            lines = _nonempty(block["lines"])
+            region.update(
+                Result.segmentation_result(
+                    (region.height, region.width),
+                    _METADATA,
+                    bboxes=[_relative(line["bbox"], block["bbox"]) for line in lines],
+                    labels=["text_line"] * len(lines),
+                )
+            )
+            for node, line in zip(region.children, lines):
+                node.update(
+                    Result.text_recognition_result(_METADATA, [line["text"]], [1.0])
+                )
+        logger.info("Page %s: used the PDF text layer instead of HTR", page.path)
+    return collection
+
+
+def run_with_text_layers(
+    config: dict, images: list[str], run, progress=None, on_pages=None
+) -> Collection:
+    """
+    Run a pipeline on the images that do not have a usable text layer.
+
+    Args:
+        config: Pipeline config (the parsed YAML)
+        images: Paths of the images to process
+        run: Function that processes images without a text layer, called as
+            `run(config, images, progress=progress, on_pages=on_pages)`
+        progress: Optional Gradio progress tracker
+        on_pages: Optional callback that receives finished pages before the
+            whole job is done. The pages read from text layers are passed
+            to it right away.
+
+    Returns:
+        A collection with the pages of all images, sorted by path
+    """
+    layered = [image for image in images if text_layer(image)]
+    if not layered:
+        return run(config, images, progress=progress, on_pages=on_pages)
+
+    logger.info(
+        "Using the PDF text layer of %d of %d image(s)", len(layered), len(images)
+    )
+    text_pages = text_layer_collection(layered, label="demo_output").pages
+    if on_pages:
+        on_pages(text_pages)
+
+    remaining = [image for image in images if image not in layered]
+    if remaining:
+        collection = run(config, remaining, progress=progress, on_pages=on_pages)
+    else:
+        collection = Collection([], label="demo_output")
+
+    pages = sorted(collection.pages + text_pages, key=lambda page: page.path)
+    return subset_collection(collection, pages)
@@ -0,0 +1,125 @@
+"""
+Thumbnails for the image galleries.
+
+The Examples and PDF galleries show a grid of small tiles, but would
+otherwise send full-resolution scans and page renders to the browser.
+Thumbnails are generated once per image content and kept in a
+content-hashed directory inside the Gradio cache, so they are served as
+they are and survive restarts. Each thumbnail has a `.source` sidecar file
+with the path of the image it was made from, which `full_image` reads when
+a tile is selected, so the mapping also survives restarts and is shared by
+all replicas that share the Gradio cache.
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# Directory of the generated thumbnails. Must be inside the Gradio cache
+# directory, so that the galleries serve the files in place.
+THUMBNAIL_DIR = os.environ.get(
+    "THUMBNAIL_DIR", os.path.join(".gradio_cache", "thumbnails")
+)
+
+# Long side of the gallery thumbnails
+THUMBNAIL_SIDE = int(os.environ.get("THUMBNAIL_SIDE", 384))
+
+_QUALITY = 80
+_FORMAT, _EXT = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+_THUMBNAIL_NAME = re.compile(r"[0-9a-f]{32}_\d+\.(webp|jpg)")
+
+
+@functools.lru_cache(maxsize=4096)
+def _digest(path: str, mtime: float, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def thumbnail(path: str, side: int = THUMBNAIL_SIDE) -> str:
+    """
+    Get a thumbnail of a local image, generating it on first use.
+
+    Args:
+        path: Path to the image
+        side: Maximum long side of the thumbnail
+
+    Returns:
+        Path to the thumbnail, or path itself if the image cannot be read
+    """
+    try:
+        stat = os.stat(path)
+        name = f"{_digest(path, stat.st_mtime, stat.st_size)}_{side}.{_EXT}"
+    except OSError:
+        return path
+
+    thumbnail_path = os.path.join(THUMBNAIL_DIR, name)
+    if not os.path.exists(thumbnail_path):
+        try:
+            with Image.open(path) as image:
+                image.draft("RGB", (side, side))
+                image = ImageOps.exif_transpose(image).convert("RGB")
+                image.thumbnail((side, side), Image.Resampling.LANCZOS)
+                os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+                tmp_path = f"{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                image.save(tmp_path, _FORMAT, quality=_QUALITY)
+                os.replace(tmp_path, thumbnail_path)
+        except (OSError, Image.DecompressionBombError) as e:
+            logger.warning("Could not create a thumbnail of %s: %s", path, e)
+            return path
+
+    _write_source(thumbnail_path, path)
+    return thumbnail_path
+
+
+def _source_path(thumbnail_path: str) -> str:
+    return f"{thumbnail_path}.source"
+
+
+def _write_source(thumbnail_path: str, path: str):
+    source_path = _source_path(thumbnail_path)
+    try:
+        with open(source_path, encoding="utf-8") as f:
+            if f.read() == path:
+                return
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{source_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(path)
+    os.replace(tmp_path, source_path)
+
+
+def full_image(path: str) -> str:
+    """
+    Get the image a thumbnail was made from.
+
+    Returns:
+        The path of the full image, or path itself if it is not a thumbnail
+
+    Raises:
+        FileNotFoundError: If path is a thumbnail whose full image is gone
+    """
+    name = os.path.basename(path)
+    if not _THUMBNAIL_NAME.fullmatch(name):
+        return path
+    try:
+        with open(
+            _source_path(os.path.join(THUMBNAIL_DIR, name)), encoding="utf-8"
+        ) as f:
+            source = f.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No source is recorded for thumbnail {name}") from None
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"The source of thumbnail {name} is gone: {source}")
+    return source
@@ -0,0 +1,157 @@
+"""
+Validation of uploaded images.
+
+Uploads are checked before anything is decoded: only the image header is
+read to get the format and dimensions. Images above the pixel budget are
+downsampled once at upload, images that are too large to decode safely are
+rejected, and files that appear more than once in a batch are processed
+only once.
+"""
+
+import hashlib
+import logging
+import os
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Uploaded images with more pixels are downsampled to this budget before
+# they are processed. 0 disables downsampling.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 60_000_000))
+
+# Uploaded images with more pixels are rejected without being decoded.
+# Pillow also refuses images above its own decompression bomb limit.
+MAX_DECODE_PIXELS = int(os.environ.get("MAX_DECODE_PIXELS", 150_000_000))
+
+# Reasons an upload was changed or dropped
+DOWNSAMPLED = "downsampled"
+DUPLICATE = "duplicate"
+TOO_LARGE = "too_large"
+UNREADABLE = "unreadable"
+
+_JPEG_QUALITY = 95
+
+
+def file_hash(path: str) -> str:
+    """sha256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def image_header(path: str) -> tuple[str, int, int] | None:
+    """
+    Read the format and size of an image without decoding it.
+
+    Returns:
+        (format, width, height), or None if the file is not a readable image
+
+    Raises:
+        Image.DecompressionBombError: If Pillow considers the image a
+            decompression bomb
+    """
+    try:
+        with Image.open(path) as image:
+            return image.format, image.width, image.height
+    except (OSError, ValueError):
+        return None
+
+
+def downsample(path: str, width: int, height: int, max_pixels: int) -> str:
+    """
+    Write a copy of an image scaled down to at most max_pixels.
+
+    JPEG images are decoded at a reduced scale directly (see
+    `PIL.Image.Image.draft`), so the full-size image is never in memory.
+
+    Returns:
+        Path to the downsampled copy, next to the original
+
+    Raises:
+        OSError: If the image data cannot be decoded
+    """
+    factor = (max_pixels / (width * height)) ** 0.5
+    size = (max(int(width * factor), 1), max(int(height * factor), 1))
+    output_path = f"{os.path.splitext(path)[0]}_{size[0]}x{size[1]}.jpg"
+    with Image.open(path) as image:
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        # Apply the orientation after scaling, since size is in stored orientation
+        image = ImageOps.exif_transpose(image)
+        image.save(output_path, "JPEG", quality=_JPEG_QUALITY)
+    return output_path
+
+
+def validate_uploads(
+    paths: list[str],
+    max_pixels: int = MAX_IMAGE_PIXELS,
+    max_decode_pixels: int = MAX_DECODE_PIXELS,
+) -> tuple[list[str | None], list[tuple[str, str]]]:
+    """
+    Validate a batch of uploaded images.
+
+    Args:
+        paths: Paths of the uploaded files
+        max_pixels: Pixel budget; larger images are downsampled (0 to disable)
+        max_decode_pixels: Larger images are rejected
+
+    Returns:
+        The path to process for each input path (the original or a
+        downsampled copy), or None for dropped images, and a list of
+        (path, reason) tuples for the images that were changed or dropped
+    """
+    seen = set()
+    results = []
+    issues = []
+    for path in paths:
+        digest = file_hash(path)
+        if digest in seen:
+            results.append(None)
+            issues.append((path, DUPLICATE))
+            continue
+        seen.add(digest)
+
+        try:
+            header = image_header(path)
+        except Image.DecompressionBombError:
+            header = (None, max_decode_pixels + 1, 1)
+        if header is None:
+            results.append(None)
+            issues.append((path, UNREADABLE))
+            continue
+
+        format_, width, height = header
+        n_pixels = width * height
+        if max_decode_pixels and n_pixels > max_decode_pixels:
+            logger.warning(
+                "Rejected %s: %dx%d exceeds the pixel limit", path, width, height
+            )
+            results.append(None)
+            issues.append((path, TOO_LARGE))
+        elif max_pixels and n_pixels > max_pixels:
+            try:
+                output_path = downsample(path, width, height, max_pixels)
+            except (OSError, ValueError):
+                # The header was readable, but the image data is not (for
+                # example a truncated file)
+                logger.warning("Rejected %s: the image data is unreadable", path)
+                results.append(None)
+                issues.append((path, UNREADABLE))
+                continue
+            logger.info(
+                "Downsampled %s (%s, %dx%d) to %s",
+                path,
+                format_,
+                width,
+                height,
+                output_path,
+            )
+            results.append(output_path)
+            issues.append((path, DOWNSAMPLED))
+        else:
+            results.append(path)
+    return results, issues
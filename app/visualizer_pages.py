@@ -0,0 +1,324 @@
+"""
+Per-page payloads and text edits of the HTR visualizer.
+
+The visualizer shows one page at a time. Instead of serializing the lines
+and regions of every page whenever the collection changes, the component
+receives the metadata of all pages (size, image and label) plus the full
+payload of the current page only. The payloads of other pages are fetched
+on navigation from the routes below, which build each page once per
+collection and cache it.
+
+Text edits are sent back as patches that hold only the changed lines. Each
+patch carries the edit version the client last saw; the server applies the
+lines through an index of the page's line nodes, updates the cached payload
+in place, and answers with the new version.
+
+Each session has one entry, registered under a random token that is only
+known to that session. The entry is replaced whenever the session displays
+a new collection, including each partial result of a running job, and only
+holds a weak reference to it: the collection stays in the session state,
+and the entry is dropped together with it. Partial results cannot be edited.
+"""
+
+import logging
+import threading
+import uuid
+import weakref
+
+from htrflow.results import TEXT_RESULT_KEY, RecognizedText
+from htrflow.volume.volume import Collection, PageNode
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.collection_utils import page_size
+from app.iiif import display_url
+
+logger = logging.getLogger(__name__)
+
+VISUALIZER_PAGES_PATH = "/visualizer/pages"
+
+
+class _Entry:
+    """A registered collection, the payloads built for its pages and its edit version."""
+
+    def __init__(self, collection: Collection, version: int = 0):
+        self._collection = weakref.ref(collection)
+        # Pages of a running job that are still being processed
+        self.pending_pages = getattr(collection, "pending_pages", 0)
+        self.version = version
+        self.lock = threading.Lock()
+        self.pages: dict[int, dict] = {}
+        # Page index -> line nodes, indexed by line id
+        self.lines: dict[int, list] = {}
+        # Page index -> line id -> the line's entry in the page payload
+        self.texts: dict[int, dict[int, dict]] = {}
+
+    def page(self, collection: Collection, page_index: int) -> dict:
+        """Build (or get the cached) payload and line index of a page of collection."""
+        with self.lock:
+            payload = self.pages.get(page_index)
+            if payload is None:
+                payload, lines = _build_page(collection.pages[page_index])
+                self.pages[page_index] = payload
+                self.lines[page_index] = lines
+                self.texts[page_index] = {
+                    line["id"]: line for region in payload["regions"] for line in region
+                }
+            return payload
+
+    @property
+    def collection(self) -> Collection | None:
+        """The registered collection, or None once it has been released."""
+        return self._collection()
+
+
+class VersionConflict(Exception):
+    """The client edited an older version of the collection."""
+
+    def __init__(self, version: int):
+        super().__init__(f"Current edit version is {version}")
+        self.version = version
+
+
+class JobRunning(Exception):
+    """The collection is a partial result of a running job."""
+
+    def __init__(self, version: int):
+        super().__init__("The job is still running")
+        self.version = version
+
+
+# Token -> entry, and session -> token
+_entries: dict[str, _Entry] = {}
+_tokens: dict[str, str] = {}
+# Reentrant, since a collection may be released (and its entry dropped) by
+# the garbage collector while the lock is held
+_lock = threading.RLock()
+
+
+def _release(owner: str, token: str):
+    """Drop the entry of a session once its collection has been released."""
+    with _lock:
+        entry = _entries.get(token)
+        if entry is not None and entry.collection is None:
+            del _entries[token]
+            if _tokens.get(owner) == token:
+                del _tokens[owner]
+
+
+def register_collection(collection: Collection, owner: str) -> str:
+    """
+    Register the collection a session displays for page payload requests.
+
+    The collection replaces the one the session registered before, under
+    the same token. Its cached page payloads are rebuilt on the next
+    request. A collection that is registered again keeps its edit version;
+    a new collection gets the next one, so that edits made against the
+    previous collection are rejected.
+
+    Args:
+        collection: The collection
+        owner: The session (or job) the collection is displayed in
+
+    Returns:
+        The token of the session
+    """
+    with _lock:
+        token = _tokens.get(owner)
+        entry = _entries.get(token) if token else None
+        if entry is None:
+            token = uuid.uuid4().hex
+            _tokens[owner] = token
+            version = 0
+        elif entry.collection is collection:
+            version = entry.version
+        else:
+            version = entry.version + 1
+        _entries[token] = _Entry(collection, version)
+    weakref.finalize(collection, _release, owner, token)
+    return token
+
+
+def page_summary(page: PageNode) -> dict:
+    """Metadata of a page, without its lines and regions."""
+    width, height = page_size(page)
+    return {
+        "width": width,
+        "height": height,
+        "path": page.path,
+        # Remote IIIF pages are shown from a screen-sized image
+        "imageUrl": display_url(page.path),
+        "label": page.label,
+    }
+
+
+def _build_page(page: PageNode) -> tuple[dict, list]:
+    """
+    Build the lines and regions of a page.
+
+    Lines are numbered in reading order. Regions are the nodes whose
+    children are all lines, each as a list of its lines' ids and texts.
+
+    Returns:
+        The payload and the line nodes, indexed by line id
+    """
+    nodes = page.traverse()
+    lines = [node for node in nodes if node.is_line()]
+
+    line_counter = 0
+    regions = []
+    for region in nodes:
+        if not (region.children and all(child.is_line() for child in region)):
+            continue
+        region_lines = []
+        for line in region:
+            region_lines.append({"id": line_counter, "text": line.text})
+            line_counter += 1
+        regions.append(region_lines)
+
+    payload = {
+        "lines": [
+            {
+                "polygonPoints": " ".join(f"{p[0]},{p[1]}" for p in line.polygon),
+                "id": idx,
+            }
+            for idx, line in enumerate(lines)
+        ],
+        "regions": regions,
+    }
+    return payload, lines
+
+
+def _entry(token: str) -> tuple[_Entry, Collection] | tuple[None, None]:
+    with _lock:
+        entry = _entries.get(token)
+    collection = entry.collection if entry else None
+    if collection is None:
+        return None, None
+    return entry, collection
+
+
+def edit_version(token: str) -> int:
+    """The edit version of a registered collection."""
+    entry, _ = _entry(token)
+    return entry.version if entry else 0
+
+
+def page_payload(token: str, page_index: int) -> dict | None:
+    """The cached payload of a page of a registered collection, or None if unknown."""
+    entry, collection = _entry(token)
+    if entry is None or not 0 <= page_index < len(collection.pages):
+        return None
+    return entry.page(collection, page_index)
+
+
+def set_line_text(line, text: str):
+    """Replace the recognized text of a line, keeping its confidence score."""
+    old_result = line.get(TEXT_RESULT_KEY)
+    score = (
+        old_result.scores[0]
+        if old_result and getattr(old_result, "scores", None)
+        else 1.0
+    )
+    line.add_data(**{TEXT_RESULT_KEY: RecognizedText([text], [score])})
+
+
+def apply_edits(token: str, version: int, edits: list[dict]) -> int | None:
+    """
+    Apply a patch of line edits to a registered collection.
+
+    Args:
+        token: Token of the collection
+        version: The edit version the patch was made against
+        edits: The changed lines, as dicts with "page" (page index), "line"
+            (line id) and "text"
+
+    Returns:
+        The edit version after the patch, which only changes if a line
+        changed, or None if the collection is unknown
+
+    Raises:
+        JobRunning: If the collection is a partial result of a running job
+        VersionConflict: If version is not the current edit version
+    """
+    entry, collection = _entry(token)
+    if entry is None:
+        return None
+    if entry.pending_pages:
+        raise JobRunning(entry.version)
+
+    n_pages = len(collection.pages)
+    for edit in edits:
+        if 0 <= edit["page"] < n_pages:
+            entry.page(collection, edit["page"])
+
+    with entry.lock:
+        if version != entry.version:
+            raise VersionConflict(entry.version)
+        changed = False
+        for edit in edits:
+            lines = entry.lines.get(edit["page"], [])
+            line_id = edit["line"]
+            if not 0 <= line_id < len(lines) or lines[line_id].text == edit["text"]:
+                continue
+            set_line_text(lines[line_id], edit["text"])
+            if line_id in entry.texts[edit["page"]]:
+                entry.texts[edit["page"]][line_id]["text"] = edit["text"]
+            changed = True
+        # Patches that change nothing do not invalidate other clients' edits
+        if changed:
+            entry.version += 1
+        return entry.version
+
+
+def get_page(request: Request) -> JSONResponse:
+    """Serve the lines and regions of one page of a displayed collection."""
+    payload = page_payload(request.path_params["token"], request.path_params["index"])
+    if payload is None:
+        return JSONResponse({"error": "Unknown page"}, status_code=404)
+    return JSONResponse(payload)
+
+
+def _parse_edits(body) -> tuple[int, list[dict]]:
+    if not isinstance(body, dict) or not isinstance(body.get("edits"), list):
+        raise ValueError("Expected an object with 'version' and 'edits'")
+    edits = [
+        {
+            "page": int(edit["page"]),
+            "line": int(edit["line"]),
+            "text": str(edit["text"]),
+        }
+        for edit in body["edits"]
+    ]
+    return int(body.get("version", 0)), edits
+
+
+async def post_edits(request: Request) -> JSONResponse:
+    """Apply a patch of line edits and acknowledge it with the new edit version."""
+    try:
+        version, edits = _parse_edits(await request.json())
+    except (ValueError, KeyError, TypeError) as e:
+        return JSONResponse({"error": f"Invalid patch: {e}"}, status_code=400)
+
+    try:
+        new_version = apply_edits(request.path_params["token"], version, edits)
+    except JobRunning as e:
+        return JSONResponse(
+            {"error": str(e), "version": e.version, "pending": True}, status_code=409
+        )
+    except VersionConflict as e:
+        return JSONResponse({"error": str(e), "version": e.version}, status_code=409)
+    if new_version is None:
+        return JSONResponse({"error": "Unknown collection"}, status_code=404)
+
+    logger.info("Applied %d line edit(s), edit version %d", len(edits), new_version)
+    return JSONResponse({"version": new_version, "applied": len(edits)})
+
+
+VISUALIZER_ROUTES = [
+    Route(
+        f"{VISUALIZER_PAGES_PATH}/{{token}}/{{index:int}}", get_page, methods=["GET"]
+    ),
+    Route(f"{VISUALIZER_PAGES_PATH}/{{token}}/edits", post_edits, methods=["POST"]),
+]
@@ -0,0 +1,127 @@
+"""
+Background warm-up of the models used by the bundled pipeline templates.
+
+At startup, every template in `app.pipelines.PIPELINES` is loaded into the
+step cache on a background thread, so the first user of a pipeline does not
+pay the cold-load cost. The warm-up status backs the readiness endpoint. It
+is checked against the step cache on every request, so a pipeline whose
+models were evicted after the warm-up is reported as such. Evicted models
+are loaded again by the next job that uses them.
+"""
+
+import functools
+import logging
+import os
+import threading
+
+import yaml
+
+from app.pipelines import PIPELINES
+from app.step_cache import STEP_CACHE
+
+logger = logging.getLogger(__name__)
+
+# Set WARMUP=false to skip loading the template models at startup
+WARMUP_ENABLED = os.environ.get("WARMUP", "true") == "true"
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+EVICTED = "evicted"
+
+_status: dict[str, str] = {name: PENDING for name in PIPELINES}
+_status_lock = threading.Lock()
+_thread: threading.Thread | None = None
+
+
+def _set_status(pipeline: str, status: str):
+    with _status_lock:
+        _status[pipeline] = status
+
+
+def _pipeline_steps(pipeline: str) -> list[dict]:
+    with open(PIPELINES[pipeline]["file"], "r") as f:
+        return yaml.safe_load(f)["steps"]
+
+
+def warm_pipeline(pipeline: str):
+    """
+    Load all steps of a bundled pipeline into the step cache.
+
+    Args:
+        pipeline: Pipeline name (must be a key in the PIPELINES directory)
+    """
+    for step in _pipeline_steps(pipeline):
+        STEP_CACHE.get(step["step"], step.get("settings", {}))
+
+
+@functools.cache
+def _step_keys(pipeline: str) -> tuple[str, ...]:
+    """Step cache keys of the steps of a bundled pipeline."""
+    return tuple(
+        STEP_CACHE.key(step["step"], step.get("settings", {}))
+        for step in _pipeline_steps(pipeline)
+    )
+
+
+def _is_cached(pipeline: str) -> bool:
+    return all(key in STEP_CACHE for key in _step_keys(pipeline))
+
+
+def _warm_all():
+    for pipeline in PIPELINES:
+        _set_status(pipeline, LOADING)
+        try:
+            warm_pipeline(pipeline)
+        except Exception:
+            logger.exception("Warm-up failed for pipeline '%s'", pipeline)
+            _set_status(pipeline, FAILED)
+        else:
+            logger.info("Warm-up complete for pipeline '%s'", pipeline)
+            _set_status(pipeline, READY)
+
+
+def start_warmup() -> threading.Thread | None:
+    """Start warming up all bundled pipelines on a background thread."""
+    global _thread
+
+    if not WARMUP_ENABLED:
+        logger.info("Model warm-up is disabled")
+        for pipeline in PIPELINES:
+            _set_status(pipeline, READY)
+        return None
+
+    if _thread is None:
+        _thread = threading.Thread(target=_warm_all, name="htr-warmup", daemon=True)
+        _thread.start()
+    return _thread
+
+
+def warmup_status() -> dict[str, str]:
+    """
+    Get the warm-up status of each bundled pipeline.
+
+    A pipeline that was warmed up but whose steps are no longer all in the
+    step cache is reported as EVICTED.
+    """
+    with _status_lock:
+        status = dict(_status)
+    if WARMUP_ENABLED:
+        for pipeline, pipeline_status in status.items():
+            if pipeline_status == READY and not _is_cached(pipeline):
+                status[pipeline] = EVICTED
+    return status
+
+
+def is_ready() -> bool:
+    """
+    Check whether the warm-up has finished.
+
+    Pipelines whose warm-up failed do not block readiness; their models are
+    loaded on first use instead, as they would be without warm-up. Neither
+    do evicted pipelines: only jobs load them again, and an unready replica
+    would not get any.
+    """
+    with _status_lock:
+        return all(status in (READY, FAILED) for status in _status.values())